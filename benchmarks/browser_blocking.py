@@ -0,0 +1,84 @@
+""" Use python 3.7
+
+Замер загрузки страниц vk.com в браузере VkGroupAudio с разными профилями блокировки ресурсов
+(models.vk.backend.BLOCKING_PROFILES).
+
+Для каждого профиля запускается отдельный Chrome, каждая страница открывается --repeat раз.
+Для каждой страницы выводятся время до события load (Navigation Timing), количество загруженных
+ресурсов и переданные байты, а после всех страниц - суммарный RSS процессов Chrome.
+
+Запуск из корня репозитория (нужен chromedriver в chromedriver/):
+
+    python -m benchmarks.browser_blocking
+    python -m benchmarks.browser_blocking --profiles images default --url https://vk.com/audios-1?section=playlists
+
+С --login страницы открываются авторизованным браузером, куки берутся из cookie_store
+(сохраняются после первого VkGroupAudio.auth этого аккаунта).
+
+"""
+
+import argparse
+import psutil
+from models.vk.backend import VkGroupAudio, BLOCKING_PROFILES
+from models.vk.tools import cookie_store
+
+
+URLS = ['https://vk.com/vk', 'https://vk.com/music']
+
+LOAD_STATS = """
+var timing = performance.timing;
+var resources = performance.getEntriesByType('resource');
+return [timing.loadEventEnd - timing.navigationStart,
+        resources.length,
+        resources.reduce(function (sum, x) { return sum + (x.transferSize || 0); }, 0)];
+"""
+
+
+def browser_rss(audio):
+    """ Суммарный RSS chromedriver и всех процессов Chrome в байтах """
+    driver = psutil.Process(audio.browser.service.process.pid)
+    total = 0
+    for process in [driver] + driver.children(recursive=True):
+        try:
+            total += process.memory_info().rss
+        except psutil.Error:
+            pass
+    return total
+
+
+def measure(profile, urls, repeat, login):
+    audio = VkGroupAudio(login, None, blocking=profile)
+    try:
+        cookies = cookie_store.get(login) if login else None
+        if cookies and not audio.auth_with_cookies(cookies):
+            print(f'{profile}: saved cookies of {login} expired, pages are loaded without auth')
+
+        for url in urls:
+            results = []
+            for _ in range(repeat):
+                audio.browser.get(url)
+                audio._wait(lambda browser: browser.execute_script('return performance.timing.loadEventEnd') > 0)
+                results.append(audio.browser.execute_script(LOAD_STATS))
+            load_ms = sorted(x[0] for x in results)[len(results) // 2]
+            resources = results[-1][1]
+            transferred = results[-1][2]
+            print(f'{profile:<8} {load_ms:6d} ms  {resources:4d} resources  {transferred / 2 ** 10:8.1f} KB  {url}')
+        print(f'{profile:<8} browser rss {browser_rss(audio) / 2 ** 20:.1f} MB')
+    finally:
+        audio.quit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Замер загрузки страниц с профилями блокировки ресурсов')
+    parser.add_argument('--profiles', nargs='+', default=list(BLOCKING_PROFILES), choices=list(BLOCKING_PROFILES))
+    parser.add_argument('--url', action='append', help='страница для замера, можно передать несколько раз')
+    parser.add_argument('--repeat', type=int, default=3, help='сколько раз открывать каждую страницу (берется медиана)')
+    parser.add_argument('--login', help='аккаунт, сохраненными куками которого авторизоваться')
+    args = parser.parse_args()
+
+    for profile in args.profiles:
+        measure(profile, args.url or URLS, args.repeat, args.login)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+""" Use python 3.7
+
+Замер запуска и управления кампанией на локальной замене VK API (MockVkApi).
+
+Повторяет шаги TargetingAssistant.start_test (дарк-посты, кампания, объявления) и тики
+TargetingManager._updating_cpm (стата, расчет CPM, обновление ставок и остановки) на уровне
+VkAdsBackend. Шаги через браузер (плейлисты, прослушивания) не выполняются: ссылки на плейлисты
+и прослушивания генерируются.
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.launch --ads 100 --ticks 10 --latency 0.05 --error-rate 0.02
+
+С --record прогон записывается в кассету, с --replay повторяется из кассеты без сервера -
+так видно, сколько времени занимает наш собственный код без ожидания сети:
+
+    python -m benchmarks.launch --record launch.jsonl.gz
+    python -m benchmarks.launch --replay launch.jsonl.gz
+
+"""
+
+import argparse
+import random
+import time
+from models.vk.backend import VkAdsBackend
+from models.vk.mock_api import MockVkApi
+from models.vk.tools import CPMCalculator
+from models.vk.transport import RecordingSession, ReplaySession
+
+
+class ApiOnlyBackend(VkAdsBackend):
+    """ VkAdsBackend, который ходит в API по адресу api_url - браузер бенчмарку не нужен и не запускается """
+
+    def __init__(self, token, api_url, session=None):
+        super().__init__(login=None, password=None, token=token, session=session)
+        self.api_url = api_url
+
+
+def report(name, counter, seconds):
+    """ counter - MockVkApi или ReplaySession, оба считают запросы по методам """
+    rps = counter.requests / seconds if seconds else 0.
+    print(f'{name:<10} {seconds:8.2f} s {counter.requests:6d} requests {rps:8.1f} req/s')
+    for method, count in sorted(counter.methods.items()):
+        print(f'    {method:<24} {count}')
+
+
+def launch(backend, ads_count):
+    """ Шаги TargetingAssistant.start_test """
+    cabinet_id = list(backend.get_cabinets())[0]
+    retarget = dict(list(backend.get_retarget(cabinet_id).items())[:ads_count])
+    playlists = [f'https://vk.com/music/playlist/-1_{n}' for n in range(len(retarget))]
+    dark_posts = backend.create_dark_posts(group_id=1, playlists=playlists, text='ПРЕМЬЕРА\n \nСлушай в ВК👇🏻')
+    campaign_id = backend.create_campaign(cabinet_id=cabinet_id, campaign_name='BENCHMARK / track', money_limit=0)
+    ads = backend.create_ads(cabinet_id=cabinet_id, campaign_id=campaign_id, retarget=retarget,
+                             posts=list(dark_posts.keys()), music=False)
+    return cabinet_id, campaign_id, ads
+
+
+def control(backend, cabinet_id, campaign_id, ads, ticks):
+    """ Тики TargetingManager._updating_cpm без ожидания между ними """
+    # Свой генератор с фиксированным seed, чтобы прогон по кассете повторял те же запросы
+    rng = random.Random(0)
+    calculator = CPMCalculator()
+    ad_ids = list(ads.keys())
+    for _ in range(ticks):
+        ads_stat = backend.get_ads_stat(cabinet_id=cabinet_id, campaign_id=campaign_id, ad_ids=ad_ids,
+                                        ad_names=backend.ad_names)
+        for stat in ads_stat.values():
+            stat['listens'] = max(1, int(stat['reach'] * rng.uniform(0.001, 0.1)))
+        cpm_dict, stop_ads = calculator.updates_for_target_cost(ads_stat)
+        backend.update_cpm(cabinet_id, cpm_dict, flush=False)
+        backend.stop_ads(cabinet_id, stop_ads, flush=False)
+        backend.flush_updates(cabinet_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Замер запуска и управления кампанией на MockVkApi')
+    parser.add_argument('--ads', type=int, default=100, help='количество объявлений (баз ретаргета)')
+    parser.add_argument('--ticks', type=int, default=10, help='количество тиков обновления CPM')
+    parser.add_argument('--latency', type=float, default=0.05, help='задержка ответа сервера, с')
+    parser.add_argument('--error-rate', type=float, default=0., help='доля ответов с ошибкой 6')
+    parser.add_argument('--rate', type=float, default=3., help='лимит запросов в секунду для RateLimiter')
+    parser.add_argument('--record', help='записать обмены с API в кассету')
+    parser.add_argument('--replay', help='прогнать по кассете без сервера')
+    args = parser.parse_args()
+
+    if args.replay:
+        api = None
+        session = counter = ReplaySession(args.replay)
+    else:
+        api = counter = MockVkApi(latency=args.latency, error_rate=args.error_rate,
+                                  retarget_count=args.ads).start()
+        session = RecordingSession(args.record) if args.record else None
+
+    backend = ApiOnlyBackend(token='benchmark', api_url=api.url if api else 'http://replay/method', session=session)
+    backend.limiter.rate = backend.limiter.max_rate = args.rate
+
+    try:
+        start = time.perf_counter()
+        cabinet_id, campaign_id, ads = launch(backend, args.ads)
+        report('launch', counter, time.perf_counter() - start)
+        print(f'    ads created: {len(ads)} / {args.ads}')
+
+        counter.reset_counters()
+        start = time.perf_counter()
+        control(backend, cabinet_id, campaign_id, ads, args.ticks)
+        report('control', counter, time.perf_counter() - start)
+    finally:
+        if api:
+            api.stop()
+        if args.record:
+            session.save()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+""" Use python 3.7
+
+Замер разбора раздела плейлистов паблика: прежний разбор через BeautifulSoup против
+потокового PlaylistParser (models.vk.backend.parse_playlists_listens).
+
+По умолчанию страница генерируется с разметкой, повторяющей раздел плейлистов ВК. Можно передать
+сохраненную страницу (browser.page_source прокрученного раздела) через --fixture:
+
+    python -m benchmarks.playlist_parser --playlists 500
+    python -m benchmarks.playlist_parser --fixture fixtures/playlists.html --name "Track"
+
+С --save сгенерированная страница записывается в файл, чтобы повторять замер на одних и тех же данных.
+
+"""
+
+import argparse
+import random
+import re
+import time
+import tracemalloc
+from bs4 import BeautifulSoup
+from models.vk.backend import parse_playlists_listens
+
+
+def parse_with_soup(html, playlist_name):
+    """ Разбор страницы в том виде, в котором он был в VkGroupAudio.get_playlists_listens """
+    soup = BeautifulSoup(html, 'lxml')
+    playlists = soup.find_all('div', class_=re.compile('^audio_pl_item2'))
+    listens = {}
+    for playlist in playlists:
+        name = playlist.find(class_='audio_item__title').get_text()
+        if name.lower() == playlist_name.lower():
+            link = playlist.find(class_='audio_pl__cover')['href']
+            url = f'https://vk.com{link}'
+            strm_1 = playlist.find(class_='audio_pl__stats_listens').get_text()
+            try:
+                strm_2 = playlist.find(class_='num_delim').get_text()
+                clicks = f'{strm_1}{strm_2}'
+                clicks = clicks.replace(' ', '')
+            except AttributeError:
+                clicks = strm_1.replace(' ', '')
+                if 'K' in clicks:
+                    try:
+                        clicks = int(clicks[:-1]) * 1000
+                    except ValueError:
+                        # Прежний код падал на '1,2K', для замера счетчик остается строкой
+                        pass
+            listens[url] = clicks
+    return listens
+
+
+def parse_with_stream(html, playlist_name):
+    listens, _ = parse_playlists_listens(html, playlist_name)
+    return listens
+
+
+def listens_html(count, rng):
+    """
+    Счетчик прослушиваний в разметке ВК: до тысячи - число, до 100К - с разделителем разрядов
+    (пробел или запятая, в span num_delim или без него), дальше - K, до миллиона - иногда с десятичной запятой
+
+    """
+    if count < 1000:
+        return str(count)
+    if count < 100000:
+        delim = rng.choice((' ', ','))
+        if rng.random() < 0.5:
+            return f'{count // 1000}{delim}{count % 1000:03d}'
+        return f'{count // 1000}<span class="num_delim">{delim}</span>{count % 1000:03d}'
+    if count % 1000 and count < 1000000:
+        return f'{count // 1000},{count % 1000 // 100}K'
+    return f'{count // 1000}K'
+
+
+def generate_page(playlists, playlist_name, seed=0):
+    """
+    Страница раздела плейлистов, половина плейлистов - с названием playlist_name
+
+    :return:    tuple - (html, {playlist_url: listens} - ожидаемый результат разбора)
+
+    """
+    rng = random.Random(seed)
+    items = []
+    expected = {}
+    for n in range(playlists):
+        title = playlist_name if n % 2 == 0 else f'Other release {n}'
+        link = f'/music/playlist/-1_{n + 1}_{rng.getrandbits(40):010x}'
+        count = rng.choice((rng.randint(0, 999), rng.randint(1000, 99999),
+                            rng.randint(100000, 900000) // 1000 * 1000, rng.randint(1000, 9999) // 100 * 100 + 100000))
+        if title == playlist_name:
+            expected[f'https://vk.com{link}'] = count
+        items.append(f'''
+<div class="audio_pl_item2 _audio_pl _audio_pl_-1_{n + 1}" data-id="-1_{n + 1}">
+  <a class="audio_pl__cover" href="{link}" onclick="return showAudioPlaylist(-1, {n + 1}, '', '', event);"
+     style="background-image:url(https://sun9-1.userapi.com/c85/v85/{n}/cover.jpg);">
+    <div class="audio_pl__cover_overlay"><button class="audio_pl__play" aria-label="play"></button></div>
+  </a>
+  <div class="audio_pl__info">
+    <a class="audio_item__title" href="{link}">{title}</a>
+    <div class="audio_pl__author"><a href="/club1">Artist</a></div>
+    <div class="audio_pl__stats">
+      <span class="audio_pl__stats_listens">{listens_html(count, rng)}</span>
+      <span class="audio_pl__stats_year">2020</span>
+    </div>
+  </div>
+</div>''')
+    header = '<html><head><script>var vk = {"id": 1};</script></head><body><div id="page_layout">' + \
+             '<div id="side_bar">' + '<a class="left_row" href="/feed">menu</a>' * 50 + '</div>' + \
+             '<div id="content"><div class="audio_page__audio_rows">'
+    return header + ''.join(items) + '</div></div></div></body></html>', expected
+
+
+def measure(func, html, playlist_name, repeat):
+    """ Лучшее время из repeat прогонов и пиковая память одного прогона """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(html, playlist_name)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+
+    tracemalloc.start()
+    func(html, playlist_name)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Замер разбора раздела плейлистов')
+    parser.add_argument('--playlists', type=int, default=500, help='количество плейлистов на сгенерированной странице')
+    parser.add_argument('--fixture', help='сохраненная страница раздела плейлистов')
+    parser.add_argument('--name', default='Track', help='название плейлистов кампании')
+    parser.add_argument('--repeat', type=int, default=5, help='количество прогонов для замера времени')
+    parser.add_argument('--save', help='записать сгенерированную страницу в файл')
+    args = parser.parse_args()
+
+    expected = None
+    if args.fixture:
+        with open(args.fixture, encoding='utf-8') as file:
+            html = file.read()
+    else:
+        html, expected = generate_page(args.playlists, args.name)
+        if args.save:
+            with open(args.save, 'w', encoding='utf-8') as file:
+                file.write(html)
+    print(f'page {len(html) / 2 ** 20:.2f} MB')
+
+    results = {}
+    for name, func in (('soup', parse_with_soup), ('stream', parse_with_stream)):
+        result, seconds, peak = measure(func, html, args.name, args.repeat)
+        results[name] = result
+        print(f'{name:<8} {seconds * 1000:8.1f} ms  peak {peak / 2 ** 20:7.2f} MB  {len(result)} playlists')
+
+    # Прежний разбор возвращает строки вида '12345' (или int для 'NK'), счетчики с запятыми он не понимает
+    soup = {}
+    for url, listens in results['soup'].items():
+        try:
+            soup[url] = int(listens)
+        except ValueError:
+            soup[url] = listens
+
+    # Сгенерированная страница сверяется с заданными счетчиками, сохраненная - с прежним разбором
+    reference = expected if expected is not None else soup
+    for name, result in (('soup', soup), ('stream', results['stream'])):
+        diff = [url for url in set(reference) | set(result) if reference.get(url) != result.get(url)]
+        if diff:
+            print(f'{name}: results differ for {len(diff)} playlists, e.g. '
+                  f'{[(reference.get(url), result.get(url)) for url in diff[:3]]}')
+        else:
+            print(f'{name}: results match')
+
+
+if __name__ == '__main__':
+    main()
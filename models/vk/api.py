@@ -0,0 +1,252 @@
+""" Use python 3.7 """
+
+import random
+import threading
+import time
+
+
+# Адрес VK API, для замеров можно подменить на MockVkApi.url
+API_URL = 'https://api.vk.com/method'
+
+# Таймауты запросов к API в секундах: (на соединение, на чтение ответа)
+TIMEOUT = (5, 30)
+
+# Сколько раз отправлять запрос, прежде чем вернуть ошибку
+MAX_ATTEMPTS = 5
+
+# Коды ошибок ВК, после которых запрос имеет смысл повторить:
+# 1 - неизвестная ошибка, 6 - слишком много запросов, 9 - flood control, 10 - внутренняя ошибка сервера
+RETRY_ERRORS = (1, 6, 9, 10)
+
+# Ошибка авторизации - токен недействителен, нужно получить новый
+AUTH_ERROR = 5
+
+# Ошибки ограничения частоты - замедляют RateLimiter, но не считаются сбоями метода
+RATE_ERRORS = (6, 9)
+
+# Методы, повторный вызов которых создает дубликаты (кампании, объявления, посты, паблики) или
+# возвращает ошибку вместо результата (удаление). Такие запросы повторяются, только если они точно
+# не дошли до ВК: не удалось соединиться или ВК отклонил запрос ошибкой 6 или 9
+NON_IDEMPOTENT_METHODS = ('ads.createCampaigns', 'ads.createAds', 'ads.deleteAds',
+                          'groups.create', 'wall.postAdsStealth')
+
+
+def backoff_delay(attempt, base=0.5, cap=30.):
+    """ Пауза перед повтором запроса: экспоненциальный рост с полным джиттером """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def is_idempotent(method, data):
+    """ Можно ли повторять запрос после таймаута чтения, 5xx и ошибок 1 и 10; execute - если в коде нет методов
+    из NON_IDEMPOTENT_METHODS """
+    if method == 'execute':
+        code = data.get('code', '')
+        return not any(f'API.{name}(' in code for name in NON_IDEMPOTENT_METHODS)
+    return method not in NON_IDEMPOTENT_METHODS
+
+
+def error_response(error_msg, error_code=0):
+    """ Ответ в формате ошибки VK API для сбоев, которые произошли на нашей стороне (таймаут, обрыв связи) """
+    return {'error': {'error_code': error_code, 'error_msg': error_msg}}
+
+
+class RateLimiter:
+    """
+    Ограничитель частоты запросов к VK API (token bucket).
+
+    В обычном режиме пропускает запросы с частотой rate в секунду (для пользовательского
+    токена ВК разрешает 3 запроса в секунду). Если ВК ответил ошибкой 6 (слишком много запросов)
+    или 9 (flood control), частота уменьшается вдвое, а после каждого успешного запроса
+    понемногу возвращается к rate.
+
+
+    Параметры:
+
+        rate - float, количество запросов в секунду в обычном режиме
+
+        burst - int, сколько запросов можно отправить подряд без ожидания
+
+        min_rate - float, ниже этой частоты ограничитель не опускается
+
+        recovery - float, на сколько увеличивается частота после успешного запроса
+
+    """
+
+    def __init__(self, rate=3., burst=3, min_rate=0.2, recovery=0.1):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.recovery = recovery
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """
+        Занимает место под один запрос
+
+        :return:        float - сколько секунд нужно подождать перед отправкой запроса
+
+        """
+        with self.lock:
+            self._refill()
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        """ Блокирует поток, пока не подойдет очередь запроса """
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    def slow_down(self):
+        """ Вызывается при ошибках 6 и 9 - уменьшает частоту вдвое и обнуляет запас запросов """
+        with self.lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.)
+
+    def speed_up(self):
+        """ Вызывается после успешного запроса - возвращает частоту к обычной """
+        with self.lock:
+            if self.rate < self.max_rate:
+                self._refill()
+                self.rate = min(self.max_rate, self.rate + self.recovery)
+
+
+class NoLimiter:
+    """ Ограничитель без ограничений - для транспортов, которые не ходят в сеть (ReplaySession) """
+
+    def reserve(self):
+        return 0.
+
+    def acquire(self):
+        pass
+
+    def slow_down(self):
+        pass
+
+    def speed_up(self):
+        pass
+
+
+# Ограничители общие для всех объектов в процессе, лимиты ВК считаются по токену
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(token):
+    """ Возвращает общий для процесса ограничитель частоты для токена """
+    with _limiters_lock:
+        if token not in _limiters:
+            _limiters[token] = RateLimiter()
+        return _limiters[token]
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для одного метода API.
+
+    После threshold сбоев подряд метод считается недоступным и запросы к нему не отправляются
+    (сбой - вызов API, который не удался после всех повторов, а не отдельная попытка)
+    reset_timeout секунд. Затем пропускается один пробный запрос: если он успешен, предохранитель
+    закрывается, если нет - снова открывается на reset_timeout секунд.
+
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30.):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """ True - запрос можно отправлять """
+        with self.lock:
+            if self.opened is None:
+                return True
+            if time.monotonic() - self.opened >= self.reset_timeout:
+                # Пробный запрос, остальные ждут его результата
+                self.opened = time.monotonic()
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened = time.monotonic()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(method):
+    """ Возвращает общий для процесса предохранитель метода API """
+    with _breakers_lock:
+        if method not in _breakers:
+            _breakers[method] = CircuitBreaker()
+        return _breakers[method]
+
+
+class TTLCache:
+    """
+    Кэш ответов API с временем жизни записей.
+    Используется для редко меняющихся списков (кабинеты, клиенты, базы ретаргета),
+    один объект кэша общий для всех бэкендов в процессе.
+
+    Ключ записи - (token, method, params), поэтому разные аккаунты не видят данные друг друга.
+
+    """
+
+    def __init__(self, ttl=600):
+        self.ttl = ttl
+        self.data = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(token, method, params):
+        return token, method, tuple(sorted(params.items()))
+
+    def get(self, key):
+        """ Возвращает сохраненное значение или None, если записи нет или она устарела """
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self.data[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            self.data[key] = (time.monotonic() + ttl, value)
+
+    def invalidate(self, token=None, method=None):
+        """ Удаляет записи токена и/или метода, без параметров очищает весь кэш """
+        with self.lock:
+            for key in list(self.data):
+                if (token is None or key[0] == token) and (method is None or key[1] == method):
+                    del self.data[key]
+
+
+# Кэш редко меняющихся ответов API, общий для всех объектов в процессе
+api_cache = TTLCache()
@@ -0,0 +1,305 @@
+""" Use python 3.7 """
+
+import asyncio
+import json
+import time
+import aiohttp
+from models.vk.backend import VkAdsBackend, VkGroupAudio
+from models.vk.api import get_breaker, api_cache, is_idempotent, TIMEOUT, MAX_ATTEMPTS
+from models.vk.metrics import metrics
+from models.vk.tools import token_store
+
+
+class AsyncVkAdsBackend(VkAdsBackend):
+    """
+    Use python 3.7
+
+    Асинхронный вариант VkAdsBackend на aiohttp.
+    Методы те же, что и у VkAdsBackend, но все они корутины - их нужно вызывать через await.
+    Позволяет держать в одном event loop запросы к API сразу по многим кабинетам и кампаниям.
+
+    Здесь только ввод-вывод: параметры вызовов, решение о повторе запроса и разбор ответов
+    общие с VkAdsBackend (его методы _request_failed, _request_answered, _execute_results, _parse_* и т.п.).
+
+    Методы, работающие через браузер или его куки (get_listens, add_audio_in_group, create_playlists),
+    выполняются в отдельном потоке, чтобы не блокировать event loop.
+
+    token обязателен: получение токена - вход в ВК с возможным вводом кода двухфакторной аутентификации,
+    оно блокирует поток. Без готового токена объект создается через await AsyncVkAdsBackend.create(login, password),
+    токен тогда получается в отдельном потоке.
+
+    session - aiohttp.ClientSession, если не передан - создается при первом запросе. Созданную
+    сессию нужно закрывать через close() или использовать объект как асинхронный контекстный менеджер:
+
+        async with AsyncVkAdsBackend(login, password, token) as backend:
+            ads = await backend.get_ads(cabinet_id, campaign_id)
+
+    """
+
+    def __init__(self, login, password, token, session=None):
+        if token is None:
+            raise ValueError('AsyncVkAdsBackend needs a token, use await AsyncVkAdsBackend.create(login, password)')
+        super().__init__(login, password, token, session)
+        self.own_session = session is None
+
+    @classmethod
+    async def create(cls, login, password, token=None, session=None):
+        """ Создание объекта, если token не передан - он берется из token_store в отдельном потоке """
+        if token is None:
+            loop = asyncio.get_event_loop()
+            token, _ = await loop.run_in_executor(None, token_store.get, login, password)
+        return cls(login, password, token, session)
+
+    def _new_session(self):
+        # Сессия aiohttp создается внутри event loop, при первом запросе
+        return None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        """ Закрытие сессии aiohttp, если она создана этим объектом """
+        if self.own_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    @staticmethod
+    def _request_not_sent(err):
+        """ Запрос упал до отправки в ВК: не удалось соединиться с сервером """
+        return isinstance(err, aiohttp.ClientConnectorError)
+
+    async def _request(self, method, data):
+        """ См. VkAdsBackend._request """
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        connect, read = TIMEOUT
+        timeout = aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+
+        breaker = get_breaker(method)
+        idempotent = is_idempotent(method, data)
+        resp = None
+        token_refreshed = False
+        for attempt in range(MAX_ATTEMPTS):
+            if attempt > 0 and not token_refreshed:
+                metrics.retry('vk_api', method)
+                await asyncio.sleep(self._retry_delay(attempt))
+
+            if not breaker.allow():
+                return self._circuit_open(method)
+
+            delay = self.limiter.reserve()
+            if delay:
+                await asyncio.sleep(delay)
+
+            start = time.perf_counter()
+            try:
+                async with self.session.post(f'{self.api_url}/{method}', data=data, timeout=timeout) as response:
+                    response.raise_for_status()
+                    resp = await response.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as err:
+                resp, retry = self._request_failed(method, err, breaker, idempotent, time.perf_counter() - start)
+                if retry:
+                    continue
+                return resp
+
+            action = self._request_answered(method, resp, breaker, idempotent, time.perf_counter() - start,
+                                            token_refreshed)
+            if action == 'refresh':
+                loop = asyncio.get_event_loop()
+                data['access_token'] = await loop.run_in_executor(None, self.refresh_token)
+                token_refreshed = True
+                continue
+            token_refreshed = False
+            if action == 'retry':
+                continue
+            return resp
+
+        return self._attempts_exhausted(method, resp, breaker)
+
+    async def _call(self, method, params):
+        """ См. VkAdsBackend._call """
+        return await self._request(method, self._method_params(params))
+
+    async def _cached_call(self, method, params):
+        """ См. VkAdsBackend._cached_call """
+        key = api_cache.key(self.token, method, params)
+        resp = api_cache.get(key)
+        if resp is None:
+            resp = await self._call(method, params)
+            if 'response' in resp:
+                api_cache.set(key, resp)
+        return resp
+
+    def _with_browser(self, func, *args):
+        """ Вызов метода func общего браузера под его блокировкой """
+        browser = self.browser
+        with browser.lock:
+            return func(browser, *args)
+
+    async def _in_browser(self, func, *args):
+        """ Выполнение метода VkGroupAudio в отдельном потоке, браузер запускается при первом вызове """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._with_browser, func, *args)
+
+    async def _execute_chunk(self, chunk):
+        resp = await self._call('execute', {'code': self._execute_code(chunk)})
+        return self._execute_results(resp, len(chunk))
+
+    async def _execute(self, calls):
+        """
+        Выполнение нескольких методов API через execute, пачки по 25 вызовов отправляются параллельно
+
+        :param calls:           list of tuple - [(method, params), ...]
+
+        :return:                list - ответы на каждый вызов в том же порядке, None - если вызов упал
+
+        """
+        chunks = [calls[i: i + 25] for i in range(0, len(calls), 25)]
+        responses = await asyncio.gather(*[self._execute_chunk(chunk) for chunk in chunks])
+        return [resp for chunk_resp in responses for resp in chunk_resp]
+
+    async def _update_ads(self, cabinet_id, data_list):
+        """ См. VkAdsBackend._update_ads """
+        return self._updated_ads(await self._execute(self._update_ads_calls(cabinet_id, data_list)))
+
+    async def _set_group_params(self, group_id, user_id):
+        resp = await self._execute(self._group_params_calls(group_id, user_id))
+        if not all(resp):
+            print(f'Something wrong with _set_group_params: {resp}')
+
+    async def get_campaigns(self, cabinet_id, client_id=None):
+        """ См. VkAdsBackend.get_campaigns """
+        resp = await self._call('ads.getCampaigns', {'account_id': cabinet_id, 'client_id': client_id})
+        return self._parse_campaigns(resp)
+
+    async def get_retarget(self, cabinet_id, client_id=None):
+        """ См. VkAdsBackend.get_retarget """
+        resp = await self._cached_call('ads.getTargetGroups', {'account_id': cabinet_id, 'client_id': client_id})
+        return self._parse_retarget(resp)
+
+    async def get_ads(self, cabinet_id, campaign_id, include_deleted=False, client_id=None):
+        """ См. VkAdsBackend.get_ads """
+        resp = await self._call('ads.getAds', self._ads_params(cabinet_id, campaign_id, include_deleted, client_id))
+        return self._parse_ads(resp, cabinet_id, campaign_id, include_deleted)
+
+    async def get_cabinets(self):
+        """ См. VkAdsBackend.get_cabinets """
+        resp = await self._cached_call('ads.getAccounts', {})
+        return self._parse_cabinets(resp)
+
+    async def get_clients(self, cabinet_id):
+        """ См. VkAdsBackend.get_clients """
+        resp = await self._cached_call('ads.getClients', {'account_id': cabinet_id})
+        return self._parse_clients(resp)
+
+    async def get_ads_stat(self, cabinet_id, campaign_id, ad_ids, ad_names, client_id=None):
+        """ См. VkAdsBackend.get_ads_stat """
+        resp = await self._call('ads.getStatistics', self._ads_stat_params(cabinet_id, ad_ids))
+
+        get_ads = self._cached_ads(cabinet_id, campaign_id, ad_ids)
+        if get_ads is None:
+            get_ads = await self.get_ads(cabinet_id, campaign_id, client_id=client_id)
+
+        return self._parse_ads_stat(resp, get_ads, ad_names)
+
+    async def get_campaign_stat(self, cabinet_id, campaign_id):
+        """ См. VkAdsBackend.get_campaign_stat """
+        resp = await self._call('ads.getStatistics', self._campaign_stat_params(cabinet_id, campaign_id))
+        return self._parse_campaign_stat(resp, campaign_id)
+
+    async def get_listens(self, group_id, playlist_name, playlist_urls=None):
+        """ См. VkAdsBackend.get_listens """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._read_listens, group_id, playlist_name, playlist_urls)
+
+    async def add_audio_in_group(self, group_id, track_name):
+        """ См. VkAdsBackend.add_audio_in_group """
+        return await self._in_browser(VkGroupAudio.add_audio_in_group, group_id, track_name)
+
+    async def create_group(self, group_name, user_id):
+        """ См. VkAdsBackend.create_group """
+        resp = await self._call('groups.create', self._data_for_create_group(group_name))
+        group_id = self._parse_group_id(resp)
+        if group_id is not None:
+            await self._set_group_params(group_id, user_id)
+        return group_id
+
+    async def create_playlists(self, group_id, playlist_name, cover_path=None, count=1, workers=1):
+        """ См. VkAdsBackend.create_playlists """
+        return await self._in_browser(VkGroupAudio.add_playlist, group_id, playlist_name, cover_path, count, workers)
+
+    async def create_dark_posts(self, group_id, playlists, text):
+        """ См. VkAdsBackend.create_dark_posts """
+        calls = self._dark_posts_calls(group_id, playlists, text)
+        return self._collect_dark_posts(group_id, playlists, await self._execute(calls))
+
+    async def create_campaign(self, cabinet_id, campaign_name, money_limit, client_id=None):
+        """ См. VkAdsBackend.create_campaign """
+        data = self._data_for_create_campaign(client_id, campaign_name, money_limit)
+        resp = await self._call('ads.createCampaigns', {'account_id': cabinet_id, 'data': json.dumps(data)})
+        return self._parse_campaign_id(resp)
+
+    async def create_ads(self, cabinet_id, campaign_id, retarget, posts, music=True, client_id=None):
+        """ См. VkAdsBackend.create_ads """
+        pending = self._pending_ads(campaign_id, retarget, posts, music)
+
+        ads_and_posts = {}
+        for attempt in range(3):
+            if not pending:
+                break
+            calls = self._create_ads_calls(cabinet_id, client_id, pending)
+            failed, unknown = self._collect_created_ads(pending, await self._execute(calls), posts, ads_and_posts)
+            if unknown:
+                resp = await self._call('ads.getAds', self._ads_params(cabinet_id, campaign_id, client_id=client_id))
+                unknown = self._check_unknown_ads(unknown, resp, posts, ads_and_posts)
+            pending = failed + unknown
+
+        return ads_and_posts
+
+    async def delete_ads(self, cabinet_id, ad_ids):
+        """ См. VkAdsBackend.delete_ads """
+        resp = await self._call('ads.deleteAds', {'account_id': cabinet_id, 'ids': json.dumps(ad_ids)})
+        return self._parse_deleted_ads(resp, cabinet_id, ad_ids)
+
+    async def flush_updates(self, cabinet_id=None):
+        """ См. VkAdsBackend.flush_updates, кабинеты обновляются параллельно """
+        async def flush(cabinet):
+            queue = self._update_queue(cabinet)
+            data_list = self._changed_only(cabinet, queue.take())
+            if data_list:
+                updated = await self._update_ads(cabinet, data_list)
+                self._update_ads_cache(cabinet, data_list, updated)
+
+        cabinets = list(self.update_queues) if cabinet_id is None else [cabinet_id]
+        await asyncio.gather(*[flush(cabinet) for cabinet in cabinets])
+
+    async def limit_ads(self, cabinet_id, ad_ids, limit, flush=True):
+        """ См. VkAdsBackend.limit_ads """
+        for ad_id in ad_ids:
+            self._update_queue(cabinet_id).put(ad_id, all_limit=limit)
+        if flush:
+            await self.flush_updates(cabinet_id)
+
+    async def stop_ads(self, cabinet_id, ad_ids, flush=True):
+        """ См. VkAdsBackend.stop_ads """
+        for ad_id in ad_ids:
+            self._update_queue(cabinet_id).put(ad_id, status=0)
+        if flush:
+            await self.flush_updates(cabinet_id)
+
+    async def start_ads(self, cabinet_id, ad_ids, flush=True):
+        """ См. VkAdsBackend.start_ads """
+        for ad_id in ad_ids:
+            self._update_queue(cabinet_id).put(ad_id, status=1)
+        if flush:
+            await self.flush_updates(cabinet_id)
+
+    async def update_cpm(self, cabinet_id, cpm_dict, flush=True):
+        """ См. VkAdsBackend.update_cpm """
+        for ad_id, cpm in cpm_dict.items():
+            self._update_queue(cabinet_id).put(ad_id, cpm=cpm)
+        if flush:
+            await self.flush_updates(cabinet_id)
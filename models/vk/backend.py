@@ -1,12 +1,114 @@
 """ Use python 3.7 """
 
 from selenium import webdriver
-from bs4 import BeautifulSoup
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
 import re
 import time
 import json
+import os
+import atexit
+import queue
+import threading
 import requests
-from models.vk.tools import get_token_and_user_id
+import urllib3
+from concurrent.futures import ThreadPoolExecutor
+from models.vk.tools import token_store, cookie_store, PlaylistParser, PlaylistPageParser, prepare_cover
+from models.vk.api import API_URL, NoLimiter, get_limiter, get_breaker, backoff_delay, error_response, api_cache
+from models.vk.api import is_idempotent
+from models.vk.api import TIMEOUT, MAX_ATTEMPTS, RETRY_ERRORS, RATE_ERRORS, AUTH_ERROR
+from models.vk.metrics import metrics
+
+
+# Сколько секунд ждать появления элемента на странице, прежде чем шаг в браузере упадет
+WAIT_TIMEOUT = 15
+
+# Сколько секунд ждать подгрузки следующей части страницы при прокрутке, прежде чем считать ее последней
+SCROLL_TIMEOUT = 2
+
+# Сколько раз пытаться создать один плейлист, прежде чем пропустить его
+PLAYLIST_ATTEMPTS = 3
+
+# Адреса шрифтов, медиа и счетчиков, которые браузеру не нужны для работы с аудиозаписями
+_FONTS = ['*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot']
+_MEDIA = ['*.mp3', '*.mp4', '*.m3u8', '*.webm', '*.ogg']
+_ANALYTICS = ['*top-fwz1.mail.ru*', '*ad.mail.ru*', '*mc.yandex.ru*', '*google-analytics.com*',
+              '*googletagmanager.com*', '*doubleclick.net*', '*facebook.net*', '*vk.com/rtrg*']
+_THIRD_PARTY = ['*yastatic.net*', '*api-maps.yandex.ru*', '*connect.ok.ru*', '*googleapis.com*', '*gstatic.com*']
+
+# Профили блокировки ресурсов в браузере VkGroupAudio:
+#   none - ничего не блокируется
+#   images - только картинки, как было изначально (профиль по умолчанию)
+#   default - картинки, шрифты, медиа и сторонние счетчики, на работу страниц не влияет
+#   strict - плюс стили и сторонние скрипты, для чтения страниц (прослушивания), не для кликов по формам
+BLOCKING_PROFILES = {
+    'none': {'prefs': {}, 'urls': []},
+    'images': {'prefs': {'profile.managed_default_content_settings.images': 2},
+               'urls': []},
+    'default': {'prefs': {'profile.managed_default_content_settings.images': 2,
+                          'profile.managed_default_content_settings.notifications': 2,
+                          'profile.managed_default_content_settings.geolocation': 2,
+                          'profile.managed_default_content_settings.media_stream': 2},
+                'urls': _FONTS + _MEDIA + _ANALYTICS},
+    'strict': {'prefs': {'profile.managed_default_content_settings.images': 2,
+                         'profile.managed_default_content_settings.notifications': 2,
+                         'profile.managed_default_content_settings.geolocation': 2,
+                         'profile.managed_default_content_settings.media_stream': 2},
+               'urls': _FONTS + _MEDIA + _ANALYTICS + _THIRD_PARTY + ['*.css', '*.css?*']},
+}
+
+# Профиль блокировки по умолчанию, можно сменить переменной окружения VK_BROWSER_BLOCKING.
+# Остается images, пока нет замеров benchmarks.browser_blocking для входа и формы плейлиста с другими профилями
+BLOCKING = os.environ.get('VK_BROWSER_BLOCKING', 'images')
+
+# Расширение, блокирующее картинки, подключается только в браузере с интерфейсом - headless Chrome не загружает расширения
+BLOCK_IMAGES_EXTENSION = 'chromedriver/Block-image_v1.1.crx'
+
+
+class PlaylistSaveError(Exception):
+    """
+    Браузер упал после нажатия кнопки сохранения плейлиста - плейлист мог быть создан,
+    поэтому такой плейлист не создается повторно
+
+    """
+
+
+def playlist_number(url):
+    """ Номер плейлиста из ссылки вида https://vk.com/music/playlist/-1_25, по нему плейлисты идут в порядке создания """
+    match = re.search(r'_(\d+)', url)
+    return int(match.group(1)) if match else 0
+
+
+def only_playlists(listens, playlist_urls):
+    """ Прослушивания только плейлистов playlist_urls, если они переданы """
+    if not playlist_urls:
+        return listens
+    return {url: listens[url] for url in playlist_urls if url in listens}
+
+
+def parse_playlists_listens(html, playlist_name):
+    """
+    Разбор страницы плейлистов паблика.
+
+    :return:    tuple - ({playlist_url: listens} для плейлистов с названием playlist_name, listens - int,
+                         list - ссылки на все плейлисты на странице)
+
+    """
+    parser = PlaylistParser()
+    parser.feed(html)
+    parser.close()
+
+    name = playlist_name.lower()
+    listens = {}
+    urls = []
+    for url, title, count in parser.playlists:
+        urls.append(url)
+        if title.lower() == name:
+            listens[url] = count
+
+    return listens, urls
 
 
 class VkGroupAudio:
@@ -24,28 +126,84 @@ class VkGroupAudio:
 
         add_audio_in_group - добавляет в аудиозаписи сообщества трек, выдаваемый первым при поисковом запросе
 
-        add_playlist - добавляет заданное количество плейлистов в аудиозаписи сообщества
+        add_playlist - добавляет заданное количество плейлистов в аудиозаписи сообщества,
+                       при workers > 1 - параллельно в нескольких браузерах
+
+    Каждый шаг ждет, пока нужный элемент станет кликабельным (или пока изменится страница),
+    но не дольше timeout секунд, после чего падает с selenium TimeoutException.
 
     """
 
-    def __init__(self, login, password, headless=True):
+    def __init__(self, login, password, headless=True, timeout=WAIT_TIMEOUT, blocking=BLOCKING):
         self.login = login
         self.password = password
+        self.headless = headless
+        self.timeout = timeout
+        if blocking not in BLOCKING_PROFILES:
+            raise ValueError(f'Unknown browser blocking profile {blocking!r} (VK_BROWSER_BLOCKING), '
+                             f'allowed: {", ".join(BLOCKING_PROFILES)}')
+        self.blocking = blocking
+        self.lock = threading.RLock()
+        self.closed = False
         self.browser = self.__config_selenium(headless)
 
     def __config_selenium(self, headless):
-        """ Конфигурация selenium (headless или с интерфейсом) """
+        """ Конфигурация selenium (headless или с интерфейсом) и блокировка ресурсов по профилю self.blocking """
 
+        profile = BLOCKING_PROFILES[self.blocking]
         chrome_options = webdriver.ChromeOptions()
-        prefs = {"profile.managed_default_content_settings.images": 2}
-        chrome_options.add_experimental_option("prefs", prefs)
+        chrome_options.add_experimental_option("prefs", profile['prefs'])
         if headless is True:
             chrome_options.add_argument('headless')
+        elif os.path.exists(BLOCK_IMAGES_EXTENSION):
+            chrome_options.add_extension(BLOCK_IMAGES_EXTENSION)
         chrome_options.add_argument('--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/'
                                     '537.36 (KHTML, like Gecko) Chrome/64.0.3282.140 Safari/537.36 Edge/18.17763')
         browser = webdriver.Chrome('chromedriver/chromedriver.exe', options=chrome_options)
+        if profile['urls']:
+            browser.execute_cdp_cmd('Network.enable', {})
+            browser.execute_cdp_cmd('Network.setBlockedURLs', {'urls': profile['urls']})
         return browser
 
+    def _wait(self, condition, timeout=None):
+        """ Ожидание условия condition, возвращает его результат """
+        return WebDriverWait(self.browser, timeout or self.timeout).until(condition)
+
+    def _find(self, xpath):
+        """ Ожидание появления элемента на странице """
+        return self._wait(EC.presence_of_element_located((By.XPATH, xpath)))
+
+    def _click(self, xpath):
+        """ Ожидание кликабельности элемента и клик по нему """
+        element = self._wait(EC.element_to_be_clickable((By.XPATH, xpath)))
+        element.click()
+        return element
+
+    def _wait_changed(self, element, html):
+        """ Ожидание изменения содержимого элемента после действия на странице """
+        self._wait(lambda browser: element.get_attribute('innerHTML') != html)
+
+    def _fill_playlist_and_save(self, playlist_name):
+        """ Название, выбор последнего трека паблика и сохранение в открытой форме нового плейлиста """
+
+        # Paste playlist_name in form
+        form = self._wait(EC.element_to_be_clickable((By.XPATH, '//*[@id="ape_pl_name"]')))
+        form.send_keys(playlist_name)
+
+        # Select last group audio and create playlist
+        self._click('//*[@id="ape_add_audios_btn"]')
+        self._click('//*[@id="box_layer"]/div[2]/div/div[2]/div/div[5]/div/div[1]')
+        save_btn = self._wait(EC.element_to_be_clickable(
+            (By.XPATH, '//*[@id="box_layer"]/div[2]/div/div[3]/div[1]/table/tbody/tr/td/button')))
+
+        # Click save and wait for the box to close, after the click the playlist may already exist
+        try:
+            save_btn.click()
+            self._wait(EC.invisibility_of_element(save_btn))
+        except WebDriverException as err:
+            raise PlaylistSaveError(f'playlist "{playlist_name}" was not confirmed after save: {err}') from err
+
+    @metrics.timed('vk_browser', 'add_playlist')
     def _add_playlist_without_cover(self, group_id, playlist_name):
         """
         Добавляет в аудиозаписи паблика плейлист без обложки
@@ -54,111 +212,86 @@ class VkGroupAudio:
         """
 
         self.browser.get(f'https://vk.com/audios-{group_id}')
-        time.sleep(1)
 
         # Click on "add playlist" button
-        add_btn = self.browser.find_element_by_xpath('//*[@id="content"]/div/div[2]/div[1]/h2/ul/button[2]')
-        add_btn.click()
-        time.sleep(1)
-
-        # Paste playlist_name in form
-        form = self.browser.find_element_by_xpath('//*[@id="ape_pl_name"]')
-        form.send_keys(playlist_name)
-        time.sleep(1)
+        self._click('//*[@id="content"]/div/div[2]/div[1]/h2/ul/button[2]')
 
-        # Select last group audio and create playlist
-        select_btn = self.browser.find_element_by_xpath('//*[@id="ape_add_audios_btn"]')
-        select_btn.click()
-        time.sleep(1)
-        audio_flag = self.browser.find_element_by_xpath('//*[@id="box_layer"]/div[2]/div/div[2]/div/div[5]/div/div[1]')
-        audio_flag.click()
-        time.sleep(1)
-        save_btn = self.browser.find_element_by_xpath('//*[@id="box_layer"]/div[2]/div/div[3]/div[1]/'
-                                                      'table/tbody/tr/td/button')
-        save_btn.click()
-        time.sleep(1)
+        self._fill_playlist_and_save(playlist_name)
 
+    @metrics.timed('vk_browser', 'add_playlist_with_cover')
     def _add_playlist_with_cover(self, group_id, playlist_name, cover_path):
         """" Добавление в аудиозаписи паблика плейлиста со своей обложкой """
 
         self.browser.get(f'https://vk.com/audios-{group_id}')
-        time.sleep(1)
 
         # Click on "add playlist" button
-        add_btn = self.browser.find_element_by_xpath('//*[@id="content"]/div/div[2]/div[1]/h2/ul/button[2]')
-        add_btn.click()
-        time.sleep(1)
+        self._click('//*[@id="content"]/div/div[2]/div[1]/h2/ul/button[2]')
 
-        # Upload cover from cover_path
-        cover_btn = self.browser.find_element_by_xpath('//*[@id="box_layer"]/div[2]/div/div[2]/div/div[1]/div[2]/input')
+        # Upload cover from cover_path and wait for its preview
+        cover_box = self._find('//*[@id="box_layer"]/div[2]/div/div[2]/div/div[1]')
+        cover_html = cover_box.get_attribute('innerHTML')
+        cover_btn = self._find('//*[@id="box_layer"]/div[2]/div/div[2]/div/div[1]/div[2]/input')
         cover_btn.send_keys(cover_path)
-        time.sleep(1)
+        self._wait_changed(cover_box, cover_html)
 
-        # Paste playlist_name in form
-        form = self.browser.find_element_by_xpath('//*[@id="ape_pl_name"]')
-        form.send_keys(playlist_name)
-        time.sleep(1)
+        self._fill_playlist_and_save(playlist_name)
 
-        # Select last group audio and create playlist
-        select_btn = self.browser.find_element_by_xpath('//*[@id="ape_add_audios_btn"]')
-        select_btn.click()
-        time.sleep(1)
-        audio_flag = self.browser.find_element_by_xpath('//*[@id="box_layer"]/div[2]/div/div[2]/div/div[5]/div/div[1]')
-        audio_flag.click()
-        time.sleep(1)
-        save_btn = self.browser.find_element_by_xpath('//*[@id="box_layer"]/div[2]/div/div[3]/div[1]/'
-                                                      'table/tbody/tr/td/button')
-        save_btn.click()
-        time.sleep(1)
-
-    def _playlists_page_scroll(self, group_id):
+    def _has_playlists(self, playlist_urls):
+        """ Есть ли на странице ссылки на все плейлисты playlist_urls """
+        links = [url.replace('https://vk.com', '', 1) for url in playlist_urls]
+        return self.browser.execute_script(
+            "return arguments[0].every(link => document.querySelector('a[href=\"' + link + '\"]'));", links)
+
+    @metrics.timed('vk_browser', 'playlists_page_scroll')
+    def _playlists_page_scroll(self, group_id, playlist_urls=None):
+        """ Прокрутка раздела плейлистов до конца или, если переданы playlist_urls, пока они все не найдутся """
         self.browser.get(f'https://vk.com/audios-{group_id}?section=playlists')
-        time.sleep(1)
 
         # Scroll to page bottom
         last_height = self.browser.execute_script("return document.body.scrollHeight")
         while True:
+            # Stop when all known playlists are loaded
+            if playlist_urls and self._has_playlists(playlist_urls):
+                break
+
             # Scroll down to bottom
             self.browser.execute_script("window.scrollTo(0, document.body.scrollHeight);")
 
-            # Wait to load page
-            time.sleep(0.5)
-
-            # Calculate new scroll height and compare with last scroll height
-            new_height = self.browser.execute_script("return document.body.scrollHeight")
-            if new_height == last_height:
+            # Wait to load next part of page, page is over if nothing loaded
+            try:
+                last_height = self._wait(lambda browser: browser.execute_script(
+                    f"return document.body.scrollHeight > {last_height} && document.body.scrollHeight"),
+                    SCROLL_TIMEOUT)
+            except TimeoutException:
                 break
-            last_height = new_height
 
+    @metrics.timed('vk_browser', 'add_audio_in_group')
     def add_audio_in_group(self, group_id, track_name):
         """ Поиск и добавление трека в аудиозаписи паблика """
 
         self.browser.get(f'https://vk.com/audios-{group_id}')
-        time.sleep(1)
 
         # Click on "add audio" button
-        add_btn = self.browser.find_element_by_xpath('//*[@id="content"]/div/div[2]/div[1]/h2/ul/button[1]')
-        add_btn.click()
-        time.sleep(1)
+        self._click('//*[@id="content"]/div/div[2]/div[1]/h2/ul/button[1]')
 
         # Click on "choise from my audios"
-        add_btn = self.browser.find_element_by_xpath('//*[@id="box_layer"]/div[2]/div/div[3]/div[1]/div[2]/a')
-        add_btn.click()
-        time.sleep(1)
+        self._click('//*[@id="box_layer"]/div[2]/div/div[3]/div[1]/div[2]/a')
 
-        # Past audio_name in search form
-        search_form = self.browser.find_element_by_xpath('//*[@id="ape_edit_playlist_search"]')
+        # Past audio_name in search form and wait for search results
+        results = self._find('//*[@id="box_layer"]/div[3]/div/div[2]/div/div[5]')
+        results_html = results.get_attribute('innerHTML')
+        search_form = self._wait(EC.element_to_be_clickable((By.XPATH, '//*[@id="ape_edit_playlist_search"]')))
         search_form.send_keys(track_name)
-        time.sleep(1)
+        self._wait_changed(results, results_html)
 
-        # Click on most relevant search result
-        add_btn = self.browser.find_element_by_xpath('//*[@id="box_layer"]/div[3]/div/div[2]/div/div[5]/div[2]/div[1]')
-        add_btn.click()
-        time.sleep(1)
+        # Click on most relevant search result and wait for it to be marked as added
+        results_html = results.get_attribute('innerHTML')
+        self._click('//*[@id="box_layer"]/div[3]/div/div[2]/div/div[5]/div[2]/div[1]')
+        self._wait_changed(results, results_html)
 
         # Check for success
         self.browser.refresh()
-        time.sleep(1)
+        self._find('//*[@id="content"]')
         html = self.browser.page_source
         if html.lower().find(track_name.lower()):
             print(f'successfully added "{track_name}" in group audios')
@@ -166,50 +299,151 @@ class VkGroupAudio:
         else:
             return False
 
-    def add_playlist(self, group_id, playlist_name, cover_path=None, count=1):
-        """ Создание плейлистов в паблике """
+    def _start_helper(self, cookies):
+        """ Дополнительный браузер, авторизованный куками этого браузера """
+        helper = VkGroupAudio(self.login, self.password, self.headless, self.timeout, self.blocking)
+        try:
+            if not helper.auth_with_cookies(cookies):
+                helper.auth()
+        except Exception:
+            helper.quit()
+            raise
+        return helper
+
+    def _start_helpers(self, count):
+        """ Запуск count дополнительных браузеров, не запустившиеся пропускаются """
+        if count < 1:
+            return []
+        cookies = self.get_all_cookies()
+        helpers = []
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            futures = [executor.submit(self._start_helper, cookies) for _ in range(count)]
+            for future in futures:
+                try:
+                    helpers.append(future.result())
+                except WebDriverException as err:
+                    print(f'browser worker was not started: {err}')
+        return helpers
 
-        playlists_old = self.get_playlists_urls(group_id, playlist_name)
+    def _create_playlists(self, workers, group_id, playlist_name, cover_path, count):
+        """
+        Создание count плейлистов браузерами workers, каждый в своем потоке берет плейлисты из общей очереди.
+        Плейлист, на котором браузер упал до нажатия кнопки сохранения, возвращается в очередь, пока не кончатся
+        PLAYLIST_ATTEMPTS попыток. Упавший после сохранения плейлист мог быть создан и не повторяется.
 
-        self.browser.get(f'https://vk.com/audios-{group_id}')
-        time.sleep(1)
+        :return:    int - количество плейлистов, которые так и не удалось создать (без упавших после сохранения)
 
+        """
+        items = queue.Queue()
         for n in range(count):
-            if cover_path is None:
-                self._add_playlist_without_cover(group_id, playlist_name)
-                print(f'playlist {n + 1} / {count} created')
-            else:
-                self._add_playlist_with_cover(group_id, playlist_name, cover_path)
-                print(f'playlist {n + 1} / {count} created')
+            items.put((n, 1))
+        lock = threading.Lock()
+        done = {'created': 0, 'failed': 0}
+
+        def work(worker):
+            while True:
+                try:
+                    n, attempt = items.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    if cover_path is None:
+                        worker._add_playlist_without_cover(group_id, playlist_name)
+                    else:
+                        worker._add_playlist_with_cover(group_id, playlist_name, cover_path)
+                except PlaylistSaveError as err:
+                    print(f'playlist {n + 1}: {err}')
+                    continue
+                except WebDriverException as err:
+                    if attempt < PLAYLIST_ATTEMPTS:
+                        items.put((n, attempt + 1))
+                    else:
+                        with lock:
+                            done['failed'] += 1
+                        print(f'playlist {n + 1} was not created after {attempt} attempts: {err}')
+                    continue
+                with lock:
+                    done['created'] += 1
+                    print(f'playlist {done["created"]} / {count} created')
+
+        with ThreadPoolExecutor(max_workers=len(workers)) as executor:
+            list(executor.map(work, workers))
+        return done['failed']
+
+    def add_playlist(self, group_id, playlist_name, cover_path=None, count=1, workers=1):
+        """
+        Создание плейлистов в паблике.
 
-        playlists_all = self.get_playlists_urls(group_id, playlist_name)
+        При workers > 1 запускается workers - 1 дополнительных браузеров с куками этого браузера,
+        плейлисты создаются всеми браузерами параллельно, после чего дополнительные браузеры закрываются.
+        Ссылки возвращаются в порядке создания плейлистов.
+        Если создать все count плейлистов не удалось, выбрасывается RuntimeError.
+
+        """
+
+        playlists_old = self.get_playlists_urls(group_id, playlist_name)
+
+        # Обложка уменьшается и сжимается один раз, все плейлисты загружают уже готовый файл
+        if cover_path is not None:
+            cover_path = prepare_cover(cover_path)
+
+        helpers = self._start_helpers(min(workers, count) - 1)
+        try:
+            failed = self._create_playlists([self] + helpers, group_id, playlist_name, cover_path, count)
+        finally:
+            for helper in helpers:
+                helper.quit()
+        if failed:
+            raise RuntimeError(f'{failed} / {count} playlists were not created in group {group_id}')
+
+        playlists_all = self.get_playlists_urls(group_id, playlist_name) or []
 
         if playlists_old is not None:
             playlist_new = list(set(playlists_all) - set(playlists_old))
-            return playlist_new
         else:
-            return playlists_all
+            playlist_new = playlists_all
+        if len(playlist_new) < count:
+            raise RuntimeError(f'only {len(playlist_new)} / {count} playlists were created in group {group_id}: '
+                               f'{sorted(playlist_new, key=playlist_number)}')
+        return sorted(playlist_new, key=playlist_number)
 
+    @metrics.timed('vk_browser', 'auth')
     def auth(self):
-        """ Авторизация selenium на vk.vom """
+        """
+        Авторизация selenium на vk.com сохраненными куками аккаунта, а если сессия истекла - через форму входа.
+        После входа куки сохраняются в cookie_store для следующих запусков.
+
+        """
+        cookies = cookie_store.get(self.login)
+        if cookies and self.auth_with_cookies(cookies):
+            print('successfully auth on vk.com with saved cookies')
+        else:
+            self._auth_form()
+        cookie_store.set(self.login, self.get_all_cookies())
+
+    def _auth_form(self):
+        """ Вход через форму на vk.com, с кодом двухфакторной аутентификации, если его спросят """
         self.browser.get('http://www.vk.com')
-        time.sleep(1)
-        login = self.browser.find_element_by_xpath('//*[@id="index_email"]')
-        password = self.browser.find_element_by_xpath('//*[@id="index_pass"]')
-        enter = self.browser.find_element_by_xpath('//*[@id="index_login_button"]')
+        login = self._find('//*[@id="index_email"]')
+        password = self._find('//*[@id="index_pass"]')
         login.send_keys(self.login)
         password.send_keys(self.password)
-        enter.click()
-        time.sleep(1)
+        self._click('//*[@id="index_login_button"]')
+        try:
+            self._wait(EC.url_matches('https://vk.com/(feed|login\\?act=authcheck)'))
+        except TimeoutException:
+            pass
         if self.browser.current_url == 'https://vk.com/feed':
             print('successfully auth on vk.com')
         elif self.browser.current_url == 'https://vk.com/login?act=authcheck':
-            two_fact_form = self.browser.find_element_by_xpath('//*[@id="authcheck_code"]')
+            two_fact_form = self._find('//*[@id="authcheck_code"]')
             two_fact_code = input('Введи код двухфакторной аутентификации: ')
             two_fact_form.send_keys(two_fact_code)
-            submit_btn = self.browser.find_element_by_xpath('//*[@id="login_authcheck_submit_btn"]')
-            submit_btn.click()
-            time.sleep(3)
+            self._click('//*[@id="login_authcheck_submit_btn"]')
+            try:
+                self._wait(EC.url_to_be('https://vk.com/feed'))
+            except TimeoutException:
+                pass
             if self.browser.current_url == 'https://vk.com/feed':
                 print('successfully auth on vk.com')
             else:
@@ -217,32 +451,79 @@ class VkGroupAudio:
         else:
             raise RuntimeError('something wrong with login on vk.com, run with headless=False to see it')
 
+    def _set_cookies(self, cookies):
+        """ Загрузка кук в браузер через DevTools, до первого перехода на vk.com """
+        for cookie in cookies:
+            params = {key: cookie[key] for key in ('name', 'value', 'domain', 'path', 'secure', 'httpOnly')
+                      if key in cookie}
+            # В selenium срок жизни куки называется expiry, в DevTools - expires, у сессионных кук его нет
+            expires = cookie.get('expires', cookie.get('expiry'))
+            if expires is not None and expires > 0:
+                params['expires'] = expires
+            self.browser.execute_cdp_cmd('Network.setCookie', params)
+
+    def _add_cookies(self, cookies):
+        """ Загрузка кук в браузер через selenium, требует открытой страницы vk.com """
+        self.browser.get('https://vk.com')
+        for cookie in cookies:
+            params = {key: cookie[key] for key in ('name', 'value', 'domain', 'path', 'secure', 'httpOnly')
+                      if key in cookie}
+            expires = cookie.get('expiry', cookie.get('expires'))
+            if expires is not None and expires > 0:
+                params['expiry'] = int(expires)
+            try:
+                self.browser.add_cookie(params)
+            except WebDriverException:
+                # Куки поддоменов (login.vk.com) со страницы vk.com через selenium не добавить
+                continue
+
+    def auth_with_cookies(self, cookies):
+        """
+        Авторизация куками (сохраненными или другого авторизованного браузера), без пароля и кода
+        двухфакторной аутентификации. Проверка сессии - один переход на ленту: если куки протухли, ВК
+        перенаправит на страницу входа.
+
+        :return:    True - если сессия действует, False - если нужен вход через форму
+
+        """
+        cookies = [x for x in cookies if x.get('domain', '').endswith('vk.com')]
+        try:
+            self._set_cookies(cookies)
+        except WebDriverException:
+            self._add_cookies(cookies)
+        self.browser.get('https://vk.com/feed')
+        return self.browser.current_url == 'https://vk.com/feed'
+
     def get_cookies(self):
         cookies = self.browser.get_cookies()
         return cookies
 
+    def get_all_cookies(self):
+        """ Все куки браузера, включая куки поддоменов (login.vk.com), а не только открытой страницы """
+        try:
+            return self.browser.execute_cdp_cmd('Network.getAllCookies', {})['cookies']
+        except WebDriverException:
+            return self.get_cookies()
+
+    @metrics.timed('vk_browser', 'get_html')
     def get_html(self, url):
         """ Получение кода страницы """
         self.browser.get(url)
-        time.sleep(1)
+        self._wait(lambda browser: browser.execute_script('return document.readyState') == 'complete')
         html = self.browser.page_source
         return html
 
+    @metrics.timed('vk_browser', 'get_playlists_urls')
     def get_playlists_urls(self, group_id, playlist_name):
         """ Получение ссылок на все плейлисты с указанным названем """
 
         self._playlists_page_scroll(group_id)
         html = self.browser.page_source
 
-        soup = BeautifulSoup(html, 'lxml')
-        playlist_objects = soup.find_all(class_='audio_item__title')
-
-        playlist_urls = []
-        for playlist in playlist_objects:
-            if playlist.get_text().lower() == playlist_name.lower():
-                link = playlist['href']
-                url = f'https://vk.com{link}'
-                playlist_urls.append(url)
+        parser = PlaylistParser()
+        parser.feed(html)
+        parser.close()
+        playlist_urls = [url for url, title, _ in parser.playlists if title.lower() == playlist_name.lower()]
 
         if playlist_urls:
             return playlist_urls
@@ -250,35 +531,151 @@ class VkGroupAudio:
             print(f'Group {group_id} have no playlists with name "{playlist_name}"')
             return None
 
-    def get_playlists_listens(self, group_id, playlist_name):
-        """ Получение количества прослушиваний со всех плейлитов с заданным названием """
+    @metrics.timed('vk_browser', 'get_playlists_listens')
+    def get_playlists_listens(self, group_id, playlist_name, playlist_urls=None):
+        """
+        Получение количества прослушиваний со всех плейлитов с заданным названием.
+        Если переданы playlist_urls, раздел прокручивается только до этих плейлистов и возвращаются только они.
 
-        self._playlists_page_scroll(group_id)
+        """
+
+        self._playlists_page_scroll(group_id, playlist_urls)
         html = self.browser.page_source
+        listens, _ = parse_playlists_listens(html, playlist_name)
+        return only_playlists(listens, playlist_urls)
 
-        soup = BeautifulSoup(html, 'lxml')
-        playlists = soup.find_all('div', class_=re.compile('^audio_pl_item2'))
-        listens = {}
-        for playlist in playlists:
-            name = playlist.find(class_='audio_item__title').get_text()
-            if name.lower() == playlist_name.lower():
-                link = playlist.find(class_='audio_pl__cover')['href']
-                url = f'https://vk.com{link}'
-                strm_1 = playlist.find(class_='audio_pl__stats_listens').get_text()
-                try:
-                    strm_2 = playlist.find(class_='num_delim').get_text()
-                    clicks = f'{strm_1}{strm_2}'
-                    clicks = clicks.replace(' ', '')
-                except AttributeError:
-                    clicks = strm_1.replace(' ', '')
-                    if 'K' in clicks:
-                        clicks = int(clicks[:-1]) * 1000
-                listens[url] = clicks
-
-        return listens
+    def quit(self):
+        """ Закрытие браузера вместе с chromedriver """
+        if not self.closed:
+            self.closed = True
+            self.browser.quit()
 
     def __del__(self):
-        self.browser.close()
+        # closed нет, если __init__ упал до запуска браузера (например, из-за неизвестного профиля блокировки)
+        if not getattr(self, 'closed', True):
+            self.browser.close()
+
+
+# Браузеры, общие для всех объектов в процессе: {login: VkGroupAudio}
+_browsers = {}
+_browsers_lock = threading.Lock()
+_login_locks = {}
+
+
+def get_browser(login, password):
+    """
+    Общий для процесса авторизованный браузер аккаунта, запускается при первом вызове.
+    Запуск и авторизация (с вводом кода двухфакторной аутентификации) идут под блокировкой
+    этого аккаунта и не задерживают браузеры других аккаунтов.
+
+    """
+    with _browsers_lock:
+        login_lock = _login_locks.setdefault(login, threading.Lock())
+    with login_lock:
+        browser = _browsers.get(login)
+        if browser is None:
+            browser = VkGroupAudio(login, password)
+            try:
+                browser.auth()
+            except Exception:
+                browser.quit()
+                raise
+            with _browsers_lock:
+                _browsers[login] = browser
+        return browser
+
+
+def close_browsers():
+    """ Закрытие всех общих браузеров, вызывается при выходе из процесса """
+    with _browsers_lock:
+        browsers = list(_browsers.values())
+        _browsers.clear()
+    for browser in browsers:
+        browser.quit()
+
+
+atexit.register(close_browsers)
+
+
+class PlaylistListensReader:
+    """
+    Получение прослушиваний плейлистов обычными HTTP запросами, без браузера.
+
+    Использует сохраненные куки аккаунта (cookie_store) и запрашивает страницу каждого нужного плейлиста,
+    счетчик берется из ее шапки. Страницы запрашиваются параллельно в workers потоков.
+
+    Если куки протухли и ВК вернул страницу входа, get_playlists_listens возвращает None -
+    тогда нужно заново авторизовать браузер и создать читателя с новыми куками.
+
+    """
+
+    def __init__(self, cookies, session=None, workers=5):
+        self.session = session if session is not None else requests.session()
+        self.session.headers['User-Agent'] = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+                                              '(KHTML, like Gecko) Chrome/64.0.3282.140 Safari/537.36 Edge/18.17763')
+        for cookie in cookies:
+            self.session.cookies.set(cookie['name'], cookie['value'],
+                                     domain=cookie.get('domain'), path=cookie.get('path', '/'))
+        self.workers = workers
+
+    def _playlist_listens(self, url):
+        """ Прослушивания одного плейлиста, None - если счетчик не прочитан, False - если куки не действуют """
+        try:
+            resp = self.session.get(url, timeout=TIMEOUT)
+            resp.raise_for_status()
+        except requests.exceptions.RequestException as err:
+            print(f'playlist page {url} was not loaded: {err}')
+            return None
+        if 'login' in resp.url or 'index_email' in resp.text:
+            return False
+        parser = PlaylistPageParser()
+        parser.feed(resp.text)
+        parser.close()
+        return parser.listens
+
+    @metrics.timed('vk_pages', 'get_playlists_listens')
+    def get_playlists_listens(self, playlist_urls):
+        """
+        Прослушивания плейлистов playlist_urls: {playlist_url: listens}, плейлистов, счетчик которых
+        прочитать не удалось, в результате нет. None - если куки больше не действуют.
+
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(self._playlist_listens, playlist_urls))
+        if any(listens is False for listens in results):
+            return None
+        return {url: listens for url, listens in zip(playlist_urls, results) if listens is not None}
+
+
+class AdsUpdateQueue:
+    """
+    Очередь изменений объявлений одного рекламного кабинета.
+
+    Все изменения одного объявления (cpm, status, all_limit), накопленные до отправки,
+    сливаются в один элемент data для ads.updateAds: более позднее значение поля заменяет
+    более раннее, так что взаимно отменяющие друг друга изменения (остановка и запуск до отправки)
+    уходят одним последним значением. Изменения, которые не меняют объявление, отбрасывает
+    VkAdsBackend.flush_updates по кэшу объявлений (ads_cache), который обновляется каждым get_ads.
+
+    """
+
+    def __init__(self):
+        self.pending = {}       # {ad_id: {field: value}} - еще не отправленные изменения
+
+    def put(self, ad_id, **fields):
+        """ Добавляет изменения объявления в очередь, более поздние значения перезаписывают ранние """
+        self.pending.setdefault(ad_id, {}).update(fields)
+
+    def take(self):
+        """
+        Забирает накопленные изменения из очереди
+
+        :return:                list of dict - [{'ad_id': ad_id, ...изменяемые поля...}, ...]
+
+        """
+        data_list = [dict(fields, ad_id=ad_id) for ad_id, fields in self.pending.items()]
+        self.pending = {}
+        return data_list
 
 
 class VkAdsBackend:
@@ -294,17 +691,34 @@ class VkAdsBackend:
 
     Если не передавать токен, то он будет создан автоматически
 
+    session - транспорт для запросов к API (по умолчанию requests.session()), например
+        RecordingSession или ReplaySession из models.vk.transport
+
+    Время, ошибки и повторы вызовов API и шагов браузера пишутся в models.vk.metrics.metrics
+
     """
 
-    def __init__(self, login, password, token=None):
+    def __init__(self, login, password, token=None, session=None):
         self.login = login
         self.password = password
         self.token = self.__check_token(token)
         self.user_id = None
-        self.browser = VkGroupAudio(login, password)
-        self.browser_auth = False
-        self.session = requests.session()
+        self.session = session if session is not None else self._new_session()
+        self.limiter = self._limiter_for(self.token)
+        self.api_url = API_URL
+        self.update_queues = {}
+        self.ads_cache = {}
         self.ad_names ={}
+        self.listens_reader = None
+
+    def _new_session(self):
+        """ Транспорт по умолчанию, если session не передан """
+        return requests.session()
+
+    @property
+    def browser(self):
+        """ Общий браузер аккаунта (VkGroupAudio), запускается и авторизуется при первом обращении """
+        return get_browser(self.login, self.password)
 
     def __check_token(self, token):
         if token is None:
@@ -312,92 +726,202 @@ class VkAdsBackend:
         else:
             return token
 
-    def _url_for_get_campaigns(self, cabinet_id, client_id):
-        # Если получаем из личного кабинета
-        if client_id is None:
-            url = f'https://api.vk.com/method/ads.getCampaigns?account_id={cabinet_id}&' \
-                  f'access_token={self.token}&v=5.103'
-        # Если получаем из кабинета агентства
-        else:
-            url = f'https://api.vk.com/method/ads.getCampaigns?account_id={cabinet_id}&' \
-                  f'client_id={client_id}&' \
-                  f'access_token={self.token}&v=5.103'
-        return url
-
-    def _url_for_get_retarget(self, cabinet_id, client_id):
-        # Если получаем из личного кабинета
-        if client_id is None:
-            url = f'https://api.vk.com/method/ads.getTargetGroups?account_id={cabinet_id}&' \
-                  f'access_token={self.token}&v=5.103'
-        # Если получаем из кабинета агентства
-        else:
-            url = f'https://api.vk.com/method/ads.getTargetGroups?account_id={cabinet_id}&' \
-                  f'client_id={client_id}&' \
-                  f'access_token={self.token}&v=5.103'
-        return url
-
-    def _url_for_get_ads(self, cabinet_id, client_id, campaign_id, include_deleted):
-        # Если получаем из личного кабинета
-        if client_id is None:
-            url = f'https://api.vk.com/method/ads.getAds?account_id={cabinet_id}&' \
-                  f'campaign_ids=[{campaign_id}]&' \
-                  f'include_deleted={include_deleted}&' \
-                  f'access_token={self.token}&v=5.103'
-        # Если получаем из кабинета агентства
-        else:
-            url = f'https://api.vk.com/method/ads.getAds?account_id={cabinet_id}&' \
-                  f'client_id={client_id}&' \
-                  f'campaign_ids=[{campaign_id}]&' \
-                  f'include_deleted={include_deleted}&' \
-                  f'access_token={self.token}&v=5.103'
-        return url
-
-    def _url_for_create_campaign(self, cabinet_id, client_id, campaign_name, money_limit):
-        # Если кампания создается в личном кабинете (не передается айди клиента)
-        if client_id is None:
-            # JSON массив с параметрами создаваемой кампании
-            data = [{
-                'type': 'promoted_posts',  # Для продвижения дарк-постов
-                'name': campaign_name,  # Название кампании
-                'all_limit': money_limit,  # Бюджет кампании
-                'status': 1  # 1 - запущена, 0 - остановлена
-            }]
-            data = json.dumps(data)
-            url = f'https://api.vk.com/method/ads.createCampaigns?account_id={cabinet_id}&' \
-                  f'data={data}&' \
-                  f'access_token={self.token}&v=5.103'
+    def _limiter_for(self, token):
+        # Транспортам без сети (ReplaySession) ограничитель частоты и паузы между повторами не нужны
+        if getattr(self.session, 'rate_limited', True):
+            return get_limiter(token)
+        return NoLimiter()
+
+    def _retry_delay(self, attempt):
+        if isinstance(self.limiter, NoLimiter):
+            return 0.
+        return backoff_delay(attempt)
+
+    @staticmethod
+    def _request_not_sent(err):
+        """ Запрос упал до отправки в ВК: таймаут соединения или не удалось соединиться с сервером """
+        if isinstance(err, requests.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(err.args[0], 'reason', None) if err.args else None
+        return isinstance(err, requests.exceptions.ConnectionError) and \
+            isinstance(reason, urllib3.exceptions.ConnectTimeoutError)
+
+    def _request(self, method, data):
+        """
+        POST запрос к методу API.
+
+        Запрос проходит через общий для токена ограничитель частоты и предохранитель метода.
+        При таймауте, обрыве связи, ответе 5xx и ошибках ВК из RETRY_ERRORS запрос повторяется
+        с экспоненциально растущей паузой, ошибки 6 и 9 дополнительно замедляют ограничитель.
+        Запросы к методам из NON_IDEMPOTENT_METHODS (и execute с ними) повторяются только если
+        не удалось соединиться с ВК или ВК ответил ошибкой 6 или 9, остальные сбои сразу возвращаются.
+        Если предохранитель метода открыт, запрос не отправляется.
+        Если ВК ответил, что токен недействителен, токен обновляется и запрос повторяется.
+
+        :param method:          str - название метода API
+        :param data:            dict - параметры метода для тела запроса
+
+        :return:                dict - ответ API или ошибка в формате API
+
+        """
+        breaker = get_breaker(method)
+        idempotent = is_idempotent(method, data)
+        resp = None
+        token_refreshed = False
+        for attempt in range(MAX_ATTEMPTS):
+            if attempt > 0 and not token_refreshed:
+                metrics.retry('vk_api', method)
+                time.sleep(self._retry_delay(attempt))
+
+            if not breaker.allow():
+                return self._circuit_open(method)
+
+            self.limiter.acquire()
+            start = time.perf_counter()
+            try:
+                response = self.session.post(f'{self.api_url}/{method}', data=data, timeout=TIMEOUT)
+                response.raise_for_status()
+                resp = response.json()
+            except (requests.exceptions.RequestException, ValueError) as err:
+                resp, retry = self._request_failed(method, err, breaker, idempotent, time.perf_counter() - start)
+                if retry:
+                    continue
+                return resp
+
+            action = self._request_answered(method, resp, breaker, idempotent, time.perf_counter() - start,
+                                            token_refreshed)
+            if action == 'refresh':
+                data['access_token'] = self.refresh_token()
+                token_refreshed = True
+                continue
+            token_refreshed = False
+            if action == 'retry':
+                continue
+            return resp
+
+        return self._attempts_exhausted(method, resp, breaker)
+
+    def _attempts_exhausted(self, method, resp, breaker):
+        """
+        Ответ _request после MAX_ATTEMPTS неудачных попыток. Предохранителю засчитывается один сбой
+        на весь вызов, ошибки 6 и 9 сбоями метода не считаются.
+
+        """
+        if resp['error'].get('error_code') not in RATE_ERRORS:
+            breaker.failure()
+        print(f'{method} failed after {MAX_ATTEMPTS} attempts: {resp}')
+        return resp
+
+    def _circuit_open(self, method):
+        """ Ответ _request, если предохранитель метода открыт и запрос не отправляется """
+        metrics.error('vk_api', method, 'circuit_open')
+        return error_response(f'{method} is temporarily unavailable (circuit open)')
+
+    def _request_failed(self, method, err, breaker, idempotent, seconds):
+        """
+        Учет запроса, на который ВК не ответил (таймаут, обрыв связи, 5xx, не JSON).
+        Сбой засчитывается предохранителю, только если запрос больше не повторяется.
+
+        :return:                tuple - (resp, retry), resp - ошибка в формате API,
+                                retry - True, если запрос можно повторить
+
+        """
+        metrics.observe('vk_api', method, seconds, type(err).__name__)
+        resp = error_response(f'{method}: {err!r}')
+        if not idempotent and not self._request_not_sent(err):
+            breaker.failure()
+            print(f'{method} failed and was not retried: {resp}')
+            return resp, False
+        return resp, True
+
+    def _request_answered(self, method, resp, breaker, idempotent, seconds, token_refreshed):
+        """
+        Учет ответа ВК в метриках, предохранителе и ограничителе частоты
+
+        :return:                str - 'refresh' - обновить токен и повторить запрос, 'retry' - повторить запрос,
+                                'done' - вернуть ответ
+
+        """
+        error_code = resp['error'].get('error_code') if 'error' in resp else None
+        metrics.observe('vk_api', method, seconds, error_code)
+        if error_code == AUTH_ERROR and not token_refreshed:
+            return 'refresh'
+        if error_code in RATE_ERRORS:
+            self.limiter.slow_down()
+            return 'retry'
+        if error_code in RETRY_ERRORS:
+            if idempotent:
+                return 'retry'
+            breaker.failure()
+            print(f'{method} failed and was not retried: {resp}')
+            return 'done'
+
+        breaker.success()
+        self.limiter.speed_up()
+        return 'done'
+
+    def _method_params(self, params):
+        """
+        Параметры метода API для тела POST запроса: убирает незаданные (None) параметры,
+        добавляет токен и версию API
+
+        """
+        data = {key: value for key, value in params.items() if value is not None}
+        data['access_token'] = self.token
+        data['v'] = '5.103'
+        return data
+
+    def _call(self, method, params):
+        """
+        Вызов метода API, параметры отправляются в теле POST запроса (form-encoded),
+        поэтому длина данных не упирается в ограничение на длину URL
+
+        :param method:          str - название метода, например 'ads.getAds'
+        :param params:          dict - параметры метода, параметры со значением None не отправляются
+
+        :return:                dict - ответ API
+
+        """
+        return self._request(method, self._method_params(params))
+
+    def _cached_call(self, method, params):
+        """
+        Вызов метода API через общий для процесса кэш (ads.getAccounts, ads.getClients, ads.getTargetGroups).
+        В кэш попадают только успешные ответы, запись живет api_cache.ttl секунд.
+
+        """
+        key = api_cache.key(self.token, method, params)
+        resp = api_cache.get(key)
+        if resp is None:
+            resp = self._call(method, params)
+            if 'response' in resp:
+                api_cache.set(key, resp)
+        return resp
+
+    def invalidate_cache(self, method=None):
+        """
+        Сбрасывает закэшированные ответы API этого аккаунта
+
+        :param method:          str - название метода, например 'ads.getTargetGroups', если None - сбрасывает все
+
+        """
+        api_cache.invalidate(self.token, method)
+
+    def _data_for_create_campaign(self, client_id, campaign_name, money_limit):
+        # JSON массив с параметрами создаваемой кампании
+        data = {
+            'type': 'promoted_posts',  # Для продвижения дарк-постов
+            'name': campaign_name,  # Название кампании
+            'all_limit': money_limit,  # Бюджет кампании
+            'status': 1  # 1 - запущена, 0 - остановлена
+        }
         # Если кампания создается в кабинете агентства (передается айди клиента)
-        else:
-            # JSON массив с параметрами создаваемой кампании
-            data = [{
-                'client_id': client_id,
-                'type': 'promoted_posts',  # Для продвижения дарк-постов
-                'name': campaign_name,  # Название кампании
-                'all_limit': money_limit,  # Бюджет кампании
-                'status': 1  # 1 - запущена, 0 - остановлена
-            }]
-            data = json.dumps(data)
-            url = f'https://api.vk.com/method/ads.createCampaigns?account_id={cabinet_id}&' \
-                  f'data={data}&' \
-                  f'access_token={self.token}&v=5.103'
-        return url
-
-    def _url_for_create_ads(self, cabinet_id, client_id, data):
-        # Если делаем в личном кабинете
-        if client_id is None:
-            url = f'https://api.vk.com/method/ads.createAds?account_id={cabinet_id}&' \
-                  f'data={data}&' \
-                  f'access_token={self.token}&v=5.103'
-        # Если делаем в кабинете агентства
-        else:
-            url = f'https://api.vk.com/method/ads.createAds?account_id={cabinet_id}&' \
-                  f'client_id={client_id}&' \
-                  f'data={data}&' \
-                  f'access_token={self.token}&v=5.103'
-        return url
+        if client_id is not None:
+            data['client_id'] = client_id
+        return [data]
 
     def _data_for_ads_without_music(self, base_id, base_name, campaign_id, post):
-        data = [{
+        data = {
             'campaign_id': campaign_id,             # Айди кампании
             'ad_format': 9,                         # Формат объявления, 9 - посты
             'autobidding': 0,                       # Автоуправление ценой
@@ -414,11 +938,11 @@ class VkAdsBackend:
             'country': 0,                           # Страна, 0 - не задана
             'user_devices': 1001,                   # Устройства, 1001 - смартфоны
             'retargeting_groups': base_id           # База ретаргета
-        }]
+        }
         return data
 
     def _data_for_ads_with_music(self, base_id, base_name, campaign_id, post):
-        data = [{
+        data = {
             'campaign_id': campaign_id,             # Айди кампании
             'ad_format': 9,                         # Формат объявления, 9 - посты
             'autobidding': 0,                       # Автоуправление ценой
@@ -436,56 +960,272 @@ class VkAdsBackend:
             'interest_categories': 10010,           # Категории интересов, 10010 - музыка
             'user_devices': 1001,                   # Устройства, 1001 - смартфоны
             'retargeting_groups': base_id           # База ретаргета
-        }]
+        }
         return data
 
-    def _set_group_params(self, group_id, user_id):
-        time.sleep(1)
-        url = f'https://api.vk.com/method/groups.edit?group_id={group_id}&' \
-              f'audio=1&' \
-              f'access_token={self.token}&v=5.103'
-        resp = self.session.get(url).json()
-        try:
-            if resp['response']:
-                pass
-        except KeyError:
-            print(resp)
+    def _execute_code(self, calls):
+        """ Код VKScript для execute: return [API.method({...}), API.method({...}), ...]; """
+        code = []
+        for method, params in calls:
+            params = {key: value for key, value in params.items() if value is not None}
+            code.append(f'API.{method}({json.dumps(params, ensure_ascii=False)})')
+        return f'return [{",".join(code)}];'
 
-        time.sleep(1)
-        url = f'https://api.vk.com/method/groups.editManager?group_id={group_id}&' \
-              f'user_id={user_id}&' \
-              f'is_contact=0&' \
-              f'access_token={self.token}&v=5.103'
-        resp = self.session.get(url).json()
+    def _execute(self, calls):
+        """
+        Выполнение нескольких методов API одним запросом через метод execute.
+        В один запрос упаковывается не более 25 вызовов, остальные уходят следующими запросами.
+
+        :param calls:           list of tuple - [(method, params), ...], method - str, например 'ads.updateAds',
+                                params - dict с параметрами метода (без access_token и v)
+
+        :return:                list - ответы на каждый вызов в том же порядке, None - если вызов упал
+
+        """
+        results = []
+        for i in range(0, len(calls), 25):
+            chunk = calls[i: i + 25]
+
+            # VKScript: return [API.method({...}), API.method({...}), ...];
+            resp = self._call('execute', {'code': self._execute_code(chunk)})
+            results.extend(self._execute_results(resp, len(chunk)))
+        return results
+
+    def _execute_results(self, resp, count):
+        """ Ответы на count вызовов из ответа execute, None - для упавших вызовов или всех, если упал execute """
         try:
-            if resp['response']:
-                pass
+            # Упавшие внутри execute вызовы возвращают false
+            results = [x if x is not False else None for x in resp['response']]
         except KeyError:
+            print('Some error with execute')
             print(resp)
+            return [None] * count
 
-    def get_token(self):
+        if 'execute_errors' in resp:
+            print(resp['execute_errors'])
+            for error in resp['execute_errors']:
+                metrics.error('vk_api', error.get('method'), error.get('error_code'))
+
+        return results
+
+    def _update_ads(self, cabinet_id, data_list):
         """
-        Получение токена для работы с кабинетом ВК, заодно получается user_id
+        Отправка изменений объявлений через ads.updateAds, по 5 объявлений на вызов,
+        вызовы пакуются в execute
 
-        :return:        tupple - (token, user_id)
+        :param cabinet_id:      int - айди рекламного кабинета (личного или агентского)
+        :param data_list:       list of dict - [{'ad_id': ad_id, ...изменяемые поля...}, ...]
+
+        :return:                list of int - айди успешно обновленных объявлений
 
         """
-        token, user_id = get_token_and_user_id(self.login, self.password)
-        self.user_id = user_id
-        return token
+        return self._updated_ads(self._execute(self._update_ads_calls(cabinet_id, data_list)))
+
+    def _update_ads_calls(self, cabinet_id, data_list):
+        """ Вызовы ads.updateAds для execute, по 5 объявлений в массиве data каждого вызова """
+        calls = []
+        for i in range(0, len(data_list), 5):
+            data = json.dumps(data_list[i: i + 5])
+            calls.append(('ads.updateAds', {'account_id': cabinet_id, 'data': data}))
+        return calls
+
+    def _updated_ads(self, responses):
+        """ Айди успешно обновленных объявлений из ответов ads.updateAds """
+        updated = []
+        for resp in responses:
+            if resp is None:
+                continue
+            for item in resp:
+                if 'error_code' in item:
+                    print(item)
+                else:
+                    updated.append(item['id'])
+        return updated
+
+    def _create_ads_calls(self, cabinet_id, client_id, pending):
+        """
+        Вызовы ads.createAds для execute, по 5 объявлений в массиве data каждого вызова
+
+        :param pending:         list of tuple - [(n, base_name, data), ...], data - dict с параметрами объявления
 
-    def get_campaigns(self, cabinet_id, client_id=None):
         """
-        Получение кампаний из рекламног кабинета
+        calls = []
+        for i in range(0, len(pending), 5):
+            data = [ad_data for _, _, ad_data in pending[i: i + 5]]
+            calls.append(('ads.createAds', {'account_id': cabinet_id,
+                                            'client_id': client_id,
+                                            'data': json.dumps(data)}))
+        return calls
+
+    def _collect_created_ads(self, pending, responses, posts, ads_and_posts):
+        """
+        Разбирает ответы ads.createAds: каждый айди созданного объявления сопоставляется с его дарк-постом
+        и добавляется в ads_and_posts, название объявления - в ad_names
 
-        :param cabinet_id: int - айди рекламного кабинета (личного или агентского)
-        :param client_id: int - айди клиента, если передеается cabinet_id агентства
+        :return:                tuple - (failed, unknown), failed - объявления из pending, которые ВК отклонил
+                                (error_code в ответе), unknown - объявления из пачек, ответа на которые нет,
+                                они могли быть созданы
 
-        :return: dict - {campaign_name: campaign_id}
+        """
+        failed = []
+        unknown = []
+        for i, resp in enumerate(responses):
+            batch = pending[i * 5: i * 5 + 5]
+            if resp is None:
+                unknown.extend(batch)
+                continue
+            for (n, base_name, ad_data), item in zip(batch, resp):
+                if 'error_code' in item:
+                    print(f'Some error with create_ads for "{base_name}": {item}')
+                    failed.append((n, base_name, ad_data))
+                else:
+                    ads_and_posts[item['id']] = posts[n]
+                    self.ad_names[item['id']] = base_name
+        return failed, unknown
+
+    def _find_created_ads(self, unknown, campaign_ads, posts, ads_and_posts):
+        """
+        Ищет объявления из unknown среди объявлений кампании (ответ ads.getAds) по названию - название
+        объявления совпадает с названием базы ретаргета и в кампании не повторяется.
+        Найденные объявления добавляются в ads_and_posts и ad_names.
 
+        :return:                list of tuple - объявления из unknown, которых в кампании нет
+
+        """
+        created = {}
+        for ad in campaign_ads:
+            if int(ad['id']) not in ads_and_posts:
+                created.setdefault(ad['name'], int(ad['id']))
+
+        missing = []
+        for n, base_name, ad_data in unknown:
+            ad_id = created.pop(base_name, None)
+            if ad_id is None:
+                missing.append((n, base_name, ad_data))
+            else:
+                ads_and_posts[ad_id] = posts[n]
+                self.ad_names[ad_id] = base_name
+        return missing
+
+    def _forget_deleted_ads(self, cabinet_id, ad_ids, results):
+        """ Убирает из кэша объявления, удаление которых прошло успешно: ads.deleteAds возвращает 0 или код ошибки """
+        for ad_id, result in zip(ad_ids, results):
+            if result != 0:
+                print(f'ad {ad_id} was not deleted, error {result}')
+                continue
+            for (cabinet, campaign_id), ads in self.ads_cache.items():
+                if cabinet == cabinet_id:
+                    ads.pop(ad_id, None)
+
+    def _check_unknown_ads(self, unknown, resp, posts, ads_and_posts):
         """
-        url = self._url_for_get_campaigns(cabinet_id, client_id)
-        resp = self.session.get(url).json()
+        Объявления из unknown, которых нет в кампании по ответу ads.getAds (см. _find_created_ads).
+        Если проверить не удалось, повторно не отправляется ни одно из них.
+
+        """
+        if 'response' in resp:
+            return self._find_created_ads(unknown, resp['response'], posts, ads_and_posts)
+        print(f'Could not check {len(unknown)} ads without response, they are not sent again: {resp}')
+        return []
+
+    def _pending_ads(self, campaign_id, retarget, posts, music):
+        """ Параметры объявлений для каждой базы ретаргета: [(n, base_name, data), ...] """
+        pending = []
+        for n, (base_name, base_id) in enumerate(retarget.items()):
+            # С сужением по интересу "музыка"
+            if music is True:
+                data = self._data_for_ads_with_music(base_id, base_name, campaign_id, posts[n])
+            else:
+                # Без сужения по интересу
+                data = self._data_for_ads_without_music(base_id, base_name, campaign_id, posts[n])
+            pending.append((n, base_name, data))
+        return pending
+
+    def _ads_params(self, cabinet_id, campaign_id, include_deleted=False, client_id=None):
+        """ Параметры ads.getAds для объявлений одной кампании """
+        return {'account_id': cabinet_id,
+                'client_id': client_id,
+                'campaign_ids': f'[{campaign_id}]',
+                'include_deleted': 1 if include_deleted else 0}
+
+    def _parse_ads(self, resp, cabinet_id, campaign_id, include_deleted):
+        """ Разбор ответа ads.getAds для get_ads, объявления без архивных запоминаются в кэше """
+        try:
+            ads = {}
+            for i in resp['response']:
+                ad_id = int(i['id'])
+                ad_name = i['name']
+                ad_cpm = i['cpm']
+                ad_status = i['status']
+                ads[ad_id] = {'name': ad_name, 'cpm': ad_cpm, 'status': ad_status}
+            if not include_deleted:
+                self.ads_cache[(cabinet_id, campaign_id)] = ads
+            return ads
+        except KeyError:
+            print(resp)
+
+    def _ads_stat_params(self, cabinet_id, ad_ids):
+        """ Параметры ads.getStatistics для статы объявлений за все время """
+        return {'account_id': cabinet_id,
+                'ids_type': 'ad',
+                'ids': ','.join(str(ad) for ad in ad_ids),
+                'period': 'overall',
+                'date_from': 0,
+                'date_to': 0}
+
+    def _parse_ads_stat(self, resp, ads, ad_names):
+        """
+        Разбор ответа ads.getStatistics для get_ads_stat, ads - объявления кампании с их CPM.
+        None - если ВК вернул ошибку или объявления кампании получить не удалось
+
+        """
+        if 'response' not in resp or ads is None:
+            print('Some error with get_ads_stat:')
+            print(resp)
+            return None
+        ads_stats = {}
+        for i in resp['response']:
+            if i['stats']:
+                cpm = float(ads[i['id']]['cpm']) / 100
+                ads_stats[i['id']] = {'name': ad_names[i['id']],
+                                      'spent': i['stats'][0]['spent'],
+                                      'reach': i['stats'][0]['impressions'],
+                                      'cpm': cpm}
+            else:
+                cpm = float(ads[i['id']]['cpm']) / 100
+                ads_stats[i['id']] = {'name': ad_names[i['id']],
+                                      'spent': 0,
+                                      'reach': 0,
+                                      'cpm': cpm}
+        return ads_stats
+
+    def _dark_posts_calls(self, group_id, playlists, text):
+        """ Вызовы wall.postAdsStealth для execute, по одному дарк-посту на плейлист """
+        playlists_ids = [x[27:] for x in playlists]
+
+        calls = []
+        for playlist_id in playlists_ids:
+            calls.append(('wall.postAdsStealth', {'owner_id': f'-{group_id}',
+                                                  'message': text,
+                                                  'attachments': f'audio_playlist{playlist_id}',
+                                                  'signed': 0}))
+        return calls
+
+    def _collect_dark_posts(self, group_id, playlists, responses):
+        """ Разбор ответов wall.postAdsStealth: {post_url: playlist_url} """
+        posts_and_playlists = {}
+        for i, resp in enumerate(responses):
+            try:
+                post_id = resp['post_id']
+                post_link = f'https://vk.com/wall-{group_id}_{post_id}'
+                posts_and_playlists[post_link] = playlists[i]
+                print(f'post {i + 1} / {(len(playlists))} created')
+            except TypeError:
+                print(f'post {i + 1} / {(len(playlists))} not created')
+        return posts_and_playlists
+
+    def _parse_campaigns(self, resp):
+        """ Разбор ответа ads.getCampaigns: {campaign_name: campaign_id} """
         try:
             campaigns = {}
             for campaign in resp['response']:
@@ -495,17 +1235,8 @@ class VkAdsBackend:
             print('Some error with get_camaigns:')
             print(resp)
 
-    def get_retarget(self, cabinet_id, client_id=None):
-        """
-        Получение баз ретаргета из рекламного кабинета
-
-        :param cabinet_id:      int - айди рекламного кабинета (личного или агентского)
-        :param client_id:       int - айди клиента, если передеается cabinet_id агентства
-        :return:                dict = {retarget_name: retarget_id}
-
-        """
-        url = self._url_for_get_retarget(cabinet_id, client_id)
-        resp = self.session.get(url).json()
+    def _parse_retarget(self, resp):
+        """ Разбор ответа ads.getTargetGroups: не больше 100 баз с аудиторией от 650000, {retarget_name: retarget_id} """
         try:
             retarget = {}
             n = 0
@@ -520,6 +1251,195 @@ class VkAdsBackend:
             print('Some error with get_retarget:')
             print(resp)
 
+    def _parse_cabinets(self, resp):
+        """ Разбор ответа ads.getAccounts: {cabinet_id: [cabinet_name, cabinet_type]} """
+        cabinets = {}
+        for cabinet in resp['response']:
+            cabinets[cabinet['account_id']] = [cabinet['account_name'], cabinet['account_type']]
+        return cabinets
+
+    def _parse_clients(self, resp):
+        """ Разбор ответа ads.getClients: {client_name: client_id} """
+        clients = {}
+        try:
+            for client in resp['response']:
+                clients[client['name']] = client['id']
+        except KeyError:
+            print(resp)
+        return clients
+
+    def _campaign_stat_params(self, cabinet_id, campaign_id):
+        """ Параметры ads.getStatistics для статы кампании за все время """
+        return {'account_id': cabinet_id,
+                'ids_type': 'campaign',
+                'ids': campaign_id,
+                'period': 'overall',
+                'date_from': 0,
+                'date_to': 0}
+
+    def _parse_campaign_stat(self, resp, campaign_id):
+        """ Разбор ответа ads.getStatistics для get_campaign_stat """
+        campaign_stat = {}
+        try:
+            stat = resp['response'][0]['stats'][0]
+            temp = {'spent': stat['spent'], 'reach': stat['impressions']}
+            campaign_stat[campaign_id] = temp
+            return campaign_stat
+        except IndexError:
+            temp = {'spent': 0, 'reach': 0}
+            campaign_stat[campaign_id] = temp
+            return campaign_stat
+        except KeyError:
+            print(resp)
+
+    def _data_for_create_group(self, group_name):
+        # Параметры groups.create: публичная страница, категория 1002, подкатегория 3
+        return {'title': group_name,
+                'type': 'public',
+                'public_category': 1002,
+                'subtype': 3}
+
+    def _parse_group_id(self, resp):
+        """ Айди созданного паблика из ответа groups.create, None - если паблик не создан """
+        try:
+            return resp['response']['id']
+        except KeyError:
+            print('Something wrong with create_group')
+            print(resp)
+
+    def _parse_campaign_id(self, resp):
+        """ Айди созданной кампании из ответа ads.createCampaigns, None - если кампания не создана """
+        try:
+            campaign_id = resp['response'][0]['id']
+            return campaign_id
+        except Exception:
+            print('Some error with create_campaign')
+            print(resp)
+
+    def _parse_deleted_ads(self, resp, cabinet_id, ad_ids):
+        """ Разбор ответа ads.deleteAds: удаленные объявления убираются из кэша, True - если ВК ответил без ошибки """
+        try:
+            if resp['response']:
+                self._forget_deleted_ads(cabinet_id, ad_ids, resp['response'])
+                return True
+            else:
+                print(resp)
+        except Exception:
+            print('Something wrong with delete_ads')
+            print(resp)
+
+    def _group_params_calls(self, group_id, user_id):
+        """ Вызовы для execute: открыть аудиозаписи паблика и убрать создателя из блока контактов """
+        return [('groups.edit', {'group_id': group_id, 'audio': 1}),
+                ('groups.editManager', {'group_id': group_id, 'user_id': user_id, 'is_contact': 0})]
+
+    def _update_queue(self, cabinet_id):
+        if cabinet_id not in self.update_queues:
+            self.update_queues[cabinet_id] = AdsUpdateQueue()
+        return self.update_queues[cabinet_id]
+
+    def _cached_ads(self, cabinet_id, campaign_id, ad_ids):
+        """ Объявления кампании из кэша, None - если в кэше нет кампании или каких-то из ad_ids """
+        ads = self.ads_cache.get((cabinet_id, campaign_id))
+        if ads is None or any(ad_id not in ads for ad_id in ad_ids):
+            return None
+        return ads
+
+    def _changed_only(self, cabinet_id, data_list):
+        """
+        Убирает из изменений объявлений поля, значения которых совпадают с кэшем объявлений
+        (по нему же тик считал ставки), и объявления, у которых не осталось изменений.
+        Объявления, которых нет в кэше, и лимиты (их в кэше нет) отправляются как есть.
+
+        """
+        cached = {}
+        for (cabinet, campaign_id), ads in self.ads_cache.items():
+            if cabinet == cabinet_id:
+                cached.update(ads)
+
+        changed = []
+        for data in data_list:
+            ad = cached.get(data['ad_id'])
+            if ad is not None:
+                data = dict(data)
+                if 'cpm' in data and round(float(ad['cpm'])) == round(data['cpm'] * 100):
+                    del data['cpm']
+                if 'status' in data and int(ad['status']) == data['status']:
+                    del data['status']
+            if len(data) > 1:
+                changed.append(data)
+        return changed
+
+    def _update_ads_cache(self, cabinet_id, data_list, updated):
+        """ Переносит в кэш объявлений успешно отправленные изменения CPM и статуса """
+        updated = set(updated)
+        for (cabinet, campaign_id), ads in self.ads_cache.items():
+            if cabinet != cabinet_id:
+                continue
+            for data in data_list:
+                ad = ads.get(data['ad_id'])
+                if ad is None or data['ad_id'] not in updated:
+                    continue
+                if 'cpm' in data:
+                    ad['cpm'] = data['cpm'] * 100
+                if 'status' in data:
+                    ad['status'] = data['status']
+
+    def _set_group_params(self, group_id, user_id):
+        resp = self._execute(self._group_params_calls(group_id, user_id))
+        if not all(resp):
+            print(f'Something wrong with _set_group_params: {resp}')
+
+    def get_token(self):
+        """
+        Получение токена для работы с кабинетом ВК, заодно получается user_id.
+        Токен берется из token_store, авторизация проходит только если сохраненного токена нет
+
+        :return:        str - token
+
+        """
+        token, user_id = token_store.get(self.login, self.password)
+        self.user_id = user_id
+        return token
+
+    def refresh_token(self):
+        """
+        Замена недействительного токена на новый, вызывается, когда ВК ответил ошибкой авторизации
+
+        :return:        str - новый token
+
+        """
+        token, user_id = token_store.refresh(self.login, self.password, self.token)
+        self.token = token
+        self.user_id = user_id
+        self.limiter = self._limiter_for(token)
+        return token
+
+    def get_campaigns(self, cabinet_id, client_id=None):
+        """
+        Получение кампаний из рекламног кабинета
+
+        :param cabinet_id: int - айди рекламного кабинета (личного или агентского)
+        :param client_id: int - айди клиента, если передеается cabinet_id агентства
+
+        :return: dict - {campaign_name: campaign_id}
+
+        """
+        resp = self._call('ads.getCampaigns', {'account_id': cabinet_id, 'client_id': client_id})
+        return self._parse_campaigns(resp)
+
+    def get_retarget(self, cabinet_id, client_id=None):
+        """
+        Получение баз ретаргета из рекламного кабинета
+
+        :param cabinet_id:      int - айди рекламного кабинета (личного или агентского)
+        :param client_id:       int - айди клиента, если передеается cabinet_id агентства
+        :return:                dict = {retarget_name: retarget_id}
+
+        """
+        resp = self._cached_call('ads.getTargetGroups', {'account_id': cabinet_id, 'client_id': client_id})
+        return self._parse_retarget(resp)
+
     def get_ads(self, cabinet_id, campaign_id, include_deleted=False, client_id=None):
         """
         Получение айди объявлений и их названий из рекламной кампании
@@ -533,24 +1453,8 @@ class VkAdsBackend:
                                        cpm - в копейках, status 1 - запущено, status 0 - остановлено
 
         """
-        if include_deleted is False:
-            include_deleted = 0
-        else:
-            include_deleted = 1
-
-        url = self._url_for_get_ads(cabinet_id, client_id, campaign_id, include_deleted)
-        resp = self.session.get(url).json()
-        try:
-            ads = {}
-            for i in resp['response']:
-                ad_id = int(i['id'])
-                ad_name = i['name']
-                ad_cpm = i['cpm']
-                ad_status = i['status']
-                ads[ad_id] = {'name': ad_name, 'cpm': ad_cpm, 'status': ad_status}
-            return ads
-        except KeyError:
-            print(resp)
+        resp = self._call('ads.getAds', self._ads_params(cabinet_id, campaign_id, include_deleted, client_id))
+        return self._parse_ads(resp, cabinet_id, campaign_id, include_deleted)
 
     def get_cabinets(self):
         """
@@ -559,12 +1463,8 @@ class VkAdsBackend:
         :return:        dict - {cabinet_name: cabinet_id}
 
         """
-        url = f'https://api.vk.com/method/ads.getAccounts?access_token={self.token}&v=5.103'
-        resp = self.session.get(url).json()
-        cabinets = {}
-        for cabinet in resp['response']:
-            cabinets[cabinet['account_id']] = [cabinet['account_name'], cabinet['account_type']]
-        return cabinets
+        resp = self._cached_call('ads.getAccounts', {})
+        return self._parse_cabinets(resp)
 
     def get_clients(self, cabinet_id):
         """
@@ -575,21 +1475,14 @@ class VkAdsBackend:
         :return:                dict - {client_name: client_id}
 
         """
-        url = f'https://api.vk.com/method/ads.getClients?&' \
-              f'account_id={cabinet_id}&' \
-              f'access_token={self.token}&v=5.103'
-        resp = self.session.get(url).json()
-        clients = {}
-        try:
-            for client in resp['response']:
-                clients[client['name']] = client['id']
-        except KeyError:
-            print(resp)
-        return clients
+        resp = self._cached_call('ads.getClients', {'account_id': cabinet_id})
+        return self._parse_clients(resp)
 
     def get_ads_stat(self, cabinet_id, campaign_id, ad_ids, ad_names, client_id=None):
         """
-        Получаем необходимую стату с рекламных объявлений
+        Получаем необходимую стату с рекламных объявлений.
+        CPM объявлений берется из кэша, который заполняет get_ads и обновляют методы изменения
+        объявлений, get_ads вызывается только если каких-то объявлений в кэше нет
 
         :param cabinet_id:      int - айди рекламного кабинета (личного или агентского)
         :param client_id:       int - айди клиента, если в cabinet_id передан агентский кабинет
@@ -597,37 +1490,17 @@ class VkAdsBackend:
         :param ad_ids:          list of int - список айди объявлений
         :param ad_names:        dict - {ad_id: ad_name}
 
-        :return:                dict - {ad_id: {'name': str, 'spent': float, 'reach': int, 'cpm': cpm}}
+        :return:                dict - {ad_id: {'name': str, 'spent': float, 'reach': int, 'cpm': cpm}},
+                                None - если стату получить не удалось
 
         """
-        ads_list = ''
-        for ad in ad_ids:
-            ads_list += f'{ad},'
-        ads_list = ads_list[:-1]
-        url = f'https://api.vk.com/method/ads.getStatistics?&ids_type=ad&period=overall&date_from=0&date_to=0&' \
-              f'account_id={cabinet_id}&' \
-              f'ids={ads_list}&' \
-              f'access_token={self.token}&v=5.103'
-        resp = self.session.get(url).json()
+        resp = self._call('ads.getStatistics', self._ads_stat_params(cabinet_id, ad_ids))
 
-        get_ads = self.get_ads(cabinet_id, campaign_id, client_id=client_id)
-
-        ads_stats = {}
-        for i in resp['response']:
-            if i['stats']:
-                cpm = float(get_ads[i['id']]['cpm']) / 100
-                ads_stats[i['id']] = {'name': ad_names[i['id']],
-                                      'spent': i['stats'][0]['spent'],
-                                      'reach': i['stats'][0]['impressions'],
-                                      'cpm': cpm}
-            else:
-                cpm = float(get_ads[i['id']]['cpm']) / 100
-                ads_stats[i['id']] = {'name': ad_names[i['id']],
-                                      'spent': 0,
-                                      'reach': 0,
-                                      'cpm': cpm}
+        get_ads = self._cached_ads(cabinet_id, campaign_id, ad_ids)
+        if get_ads is None:
+            get_ads = self.get_ads(cabinet_id, campaign_id, client_id=client_id)
 
-        return ads_stats
+        return self._parse_ads_stat(resp, get_ads, ad_names)
 
     def get_campaign_stat(self, cabinet_id, campaign_id):
         """
@@ -639,41 +1512,57 @@ class VkAdsBackend:
         :return:                dict - {campaign_id: {'spent': spent, 'reach': reach}}
 
         """
-        url = f'https://api.vk.com/method/ads.getStatistics?&ids_type=campaign&period=overall&date_from=0&date_to=0&' \
-              f'account_id={cabinet_id}&' \
-              f'ids={campaign_id}&' \
-              f'access_token={self.token}&v=5.103'
-        resp = self.session.get(url).json()
+        resp = self._call('ads.getStatistics', self._campaign_stat_params(cabinet_id, campaign_id))
+        return self._parse_campaign_stat(resp, campaign_id)
 
-        campaign_stat = {}
-        try:
-            stat = resp['response'][0]['stats'][0]
-            temp = {'spent': stat['spent'], 'reach': stat['impressions']}
-            campaign_stat[campaign_id] = temp
-            return campaign_stat
-        except IndexError:
-            temp = {'spent': 0, 'reach': 0}
-            campaign_stat[campaign_id] = temp
-            return campaign_stat
-        except KeyError:
-            print(resp)
-
-    def get_listens(self, group_id, playlist_name):
+    def get_listens(self, group_id, playlist_name, playlist_urls=None):
         """
         Получение количества прослушиваний плейлистов в паблике на текущий момент
 
         :param group_id:        str или int - айди паблика, к которому у аккаунта есть админский доступ
         :param playlist_name:   str - название плейлситов, с которых будут взять прослушивания
+        :param playlist_urls:   list of str - ссылки на нужные плейлисты, если переданы - раздел плейлистов
+                                читается только до них (по возможности без браузера) и возвращаются только они
 
         :return:                dict - {playlist_url: playlist_listens}
 
         """
-        # Проверка на авторизованность selenium в объекте
-        if self.browser_auth is False:
-            self.browser.auth()
-            self.browser_auth = True
+        return self._read_listens(group_id, playlist_name, playlist_urls)
 
-        return self.browser.get_playlists_listens(group_id, playlist_name)
+    def _read_listens(self, group_id, playlist_name, playlist_urls=None):
+        """
+        Прослушивания плейлистов playlist_urls через HTTP с сохраненными куками аккаунта, браузер запускается,
+        только если кук нет или они протухли. Без playlist_urls или если какие-то счетчики прочитать
+        не удалось, прослушивания берутся через браузер с прокруткой раздела плейлистов.
+
+        """
+        listens = None
+        if playlist_urls:
+            if self.listens_reader is None:
+                self.listens_reader = self._new_listens_reader(cookie_store.get(self.login))
+            listens = self.listens_reader.get_playlists_listens(playlist_urls)
+            if listens is None:
+                # Куки протухли - браузер входит заново и сохраняет новые куки в cookie_store
+                with self.browser.lock:
+                    self.browser.auth()
+                self.listens_reader = self._new_listens_reader(cookie_store.get(self.login))
+                listens = self.listens_reader.get_playlists_listens(playlist_urls)
+            if listens is not None and any(url not in listens for url in playlist_urls):
+                listens = None
+            if listens is None:
+                print('Не удалось получить прослушивания всех плейлистов без браузера, '
+                      'прослушивания получены через браузер')
+        if listens is None:
+            with self.browser.lock:
+                listens = self.browser.get_playlists_listens(group_id, playlist_name, playlist_urls)
+        return listens
+
+    def _new_listens_reader(self, cookies):
+        """ Читатель прослушиваний с куками cookies, если их нет - куки берутся у авторизованного браузера """
+        if not cookies:
+            with self.browser.lock:
+                cookies = self.browser.get_all_cookies()
+        return PlaylistListensReader(cookies)
 
     def add_audio_in_group(self, group_id, track_name):
         """
@@ -685,12 +1574,9 @@ class VkAdsBackend:
         :return:                True - если трек добавлен, False - если не добавлен
 
         """
-        # Проверка на авторизованность selenium в объекте
-        if self.browser_auth is False:
-            self.browser.auth()
-            self.browser_auth = True
-
-        return self.browser.add_audio_in_group(group_id, track_name)
+        browser = self.browser
+        with browser.lock:
+            return browser.add_audio_in_group(group_id, track_name)
 
     def create_group(self, group_name, user_id):
         """
@@ -702,22 +1588,13 @@ class VkAdsBackend:
         :return:                int - group_id
 
         """
-        url = f'https://api.vk.com/method/groups.create?title={group_name}&' \
-              f'type=public&' \
-              f'public_category=1002&' \
-              f'subtype=3&' \
-              f'access_token={self.token}&v=5.103'
-
-        resp = self.session.get(url).json()
-        try:
-            group_id = resp['response']['id']
+        resp = self._call('groups.create', self._data_for_create_group(group_name))
+        group_id = self._parse_group_id(resp)
+        if group_id is not None:
             self._set_group_params(group_id, user_id)
-            return group_id
-        except KeyError:
-            print('Something wrong with create_group')
-            print(resp)
+        return group_id
 
-    def create_playlists(self, group_id, playlist_name, cover_path=None, count=1):
+    def create_playlists(self, group_id, playlist_name, cover_path=None, count=1, workers=1):
         """
         Создание плейлистов в паблике, у которого есть хотя бы один трек в аудио
 
@@ -725,16 +1602,15 @@ class VkAdsBackend:
         :param playlist_name:   str - название для плейлистов
         :param cover_path:      str - путь до изображения на диске, которое будет обложкой плейлиста
         :param count:           int - количество плейлистов, которое нужно создать
+        :param workers:         int - количество браузеров, которые создают плейлисты параллельно
 
-        :return:                list - список ссылок на созданные плейлисты
+        :return:                list - список ссылок на созданные плейлисты в порядке создания,
+                                если создать все count плейлистов не удалось - RuntimeError
 
         """
-        # Проверка на авторизованность selenium в объекте
-        if self.browser_auth is False:
-            self.browser.auth()
-            self.browser_auth = True
-
-        return self.browser.add_playlist(group_id, playlist_name, cover_path, count)
+        browser = self.browser
+        with browser.lock:
+            return browser.add_playlist(group_id, playlist_name, cover_path, count, workers)
 
     def create_dark_posts(self, group_id, playlists, text):
         """ Создание дарк-постов в паблике для последующего их использования в таргете
@@ -746,25 +1622,8 @@ class VkAdsBackend:
         :return:                dict - {post_url: playlist_url}
 
         """
-        playlists_ids = [x[27:] for x in playlists]
-
-        posts_and_playlists = {}
-        for i in range(len(playlists)):
-            url = f'https://api.vk.com/method/wall.postAdsStealth?owner_id=-{group_id}&' \
-                  f'message={text}&' \
-                  f'attachments=audio_playlist{playlists_ids[i]}&' \
-                  f'signed=0&access_token={self.token}&v=5.103'
-            resp = self.session.get(url).json()
-            try:
-                post_id = resp['response']['post_id']
-                post_link = f'https://vk.com/wall-{group_id}_{post_id}'
-                posts_and_playlists[post_link] = playlists[i]
-                print(f'post {i + 1} / {(len(playlists))} created')
-                time.sleep(0.4)
-            except KeyError:
-                print(resp)
-
-        return posts_and_playlists
+        calls = self._dark_posts_calls(group_id, playlists, text)
+        return self._collect_dark_posts(group_id, playlists, self._execute(calls))
 
     def create_campaign(self, cabinet_id, campaign_name, money_limit, client_id=None):
         """
@@ -778,17 +1637,10 @@ class VkAdsBackend:
         :return:                int - campaign_id
 
         """
-
-
-        url = self._url_for_create_campaign(cabinet_id, client_id, campaign_name, money_limit)
-        resp = self.session.get(url).json()
+        data = self._data_for_create_campaign(client_id, campaign_name, money_limit)
+        resp = self._call('ads.createCampaigns', {'account_id': cabinet_id, 'data': json.dumps(data)})
         print(resp)
-        try:
-            campaign_id = resp['response'][0]['id']
-            return campaign_id
-        except Exception:
-            print('Some error with create_campaign')
-            print(resp)
+        return self._parse_campaign_id(resp)
 
     def create_ads(self, cabinet_id, campaign_id, retarget, posts, music=True, client_id=None):
         """
@@ -804,29 +1656,22 @@ class VkAdsBackend:
         :return:                dict - {ad_id: post_url}
 
         """
-        # Цикл для создания объявлений для каждой базы ретаргета
-        ads_and_posts = {}
-        for n, (base_name, base_id) in enumerate(retarget.items()):
-            # С сужением по интересу "музыка"
-            if music is True:
-                data = self._data_for_ads_with_music(base_id, base_name, campaign_id, posts[n])
-            else:
-                # Без сужения по интересу
-                data = self._data_for_ads_without_music(base_id, base_name, campaign_id, posts[n])
-
-            data = json.dumps(data)
-            url = self._url_for_create_ads(cabinet_id, client_id, data)
-            resp = self.session.get(url).json()
-            try:
-                ad_id = resp['response'][0]['id']
-                ads_and_posts[ad_id] = posts[n]
-                self.ad_names[ad_id] = base_name
-                print(f'ad {n + 1} / {len(retarget)} created')
-            except KeyError:
-                print('Some error with create_ads')
-                print(resp)
+        pending = self._pending_ads(campaign_id, retarget, posts, music)
 
-            time.sleep(3)
+        # Объявления создаются пачками по 5 в вызове и по 25 вызовов в execute,
+        # повторно отправляются только те объявления, которые ВК отклонил
+        ads_and_posts = {}
+        for attempt in range(3):
+            if not pending:
+                break
+            calls = self._create_ads_calls(cabinet_id, client_id, pending)
+            failed, unknown = self._collect_created_ads(pending, self._execute(calls), posts, ads_and_posts)
+            if unknown:
+                # Пачки без ответа могли быть созданы - сначала проверяется, каких объявлений нет в кампании
+                resp = self._call('ads.getAds', self._ads_params(cabinet_id, campaign_id, client_id=client_id))
+                unknown = self._check_unknown_ads(unknown, resp, posts, ads_and_posts)
+            pending = failed + unknown
+            print(f'{len(ads_and_posts)} / {len(retarget)} ads created')
 
         return ads_and_posts
 
@@ -838,126 +1683,84 @@ class VkAdsBackend:
         :param ad_ids:          list of int - список айди объявлений, не более 100
 
         """
-        ids = json.dumps(ad_ids)
-        url = f'https://api.vk.com/method/ads.deleteAds?account_id={cabinet_id}&' \
-              f'ids={ids}&' \
-              f'access_token={self.token}&v=5.103'
+        resp = self._call('ads.deleteAds', {'account_id': cabinet_id, 'ids': json.dumps(ad_ids)})
+        return self._parse_deleted_ads(resp, cabinet_id, ad_ids)
 
-        resp = self.session.get(url).json()
-        try:
-            if resp['response']:
-                return True
-            else:
-                print(resp)
-        except Exception:
-            print('Something wrong with delete_ads')
-            print(resp)
+    def flush_updates(self, cabinet_id=None):
+        """
+        Отправляет накопленные изменения объявлений (CPM, статус, лимит) одним пакетом:
+        по одному элементу data на объявление, по 5 объявлений в вызове ads.updateAds.
+        Изменения, которые не меняют объявление по кэшу объявлений, не отправляются.
 
-    def limit_ads(self, cabinet_id, ad_ids, limit):
+        :param cabinet_id:      int - айди рекламного кабинета, если None - отправляются изменения всех кабинетов
+
+        """
+        cabinets = list(self.update_queues) if cabinet_id is None else [cabinet_id]
+        for cabinet in cabinets:
+            queue = self._update_queue(cabinet)
+            data_list = self._changed_only(cabinet, queue.take())
+            if data_list:
+                updated = self._update_ads(cabinet, data_list)
+                self._update_ads_cache(cabinet, data_list, updated)
+
+    def limit_ads(self, cabinet_id, ad_ids, limit, flush=True):
         """
         Устанавливает ограничения по бюджету на объявления, 0 - без ограничения
 
         :param cabinet_id:      int - айди рекламного кабинета (личного или агентского)
         :param ad_ids:          list of int - список айди объявлений
         :param limit:           int - ограничение по бюджету на каждое объявление в рублях
+        :param flush:           True - сразу отправить изменения, False - оставить в очереди до flush_updates
 
         """
-        for i in range(0, len(ad_ids), 5):
-            try:
-                ids = ad_ids[i: i + 5]
-            except IndexError:
-                ids = ad_ids[i:]
-            data_list = []
-            for x in ids:
-                data = {'ad_id': x, 'all_limit': limit}
-                data_list.append(data)
-            data = json.dumps(data_list)
-            url = f'https://api.vk.com/method/ads.updateAds?account_id={cabinet_id}&' \
-                  f'data={data}&' \
-                  f'access_token={self.token}&v=5.103'
-            resp = self.session.get(url).json()
-            time.sleep(1)
-
-    def stop_ads(self, cabinet_id, ad_ids):
+        queue = self._update_queue(cabinet_id)
+        for ad_id in ad_ids:
+            queue.put(ad_id, all_limit=limit)
+        if flush:
+            self.flush_updates(cabinet_id)
+
+    def stop_ads(self, cabinet_id, ad_ids, flush=True):
         """
         Останавливает активные объявления
 
         :param cabinet_id:      int - айди рекламного кабинета (личного или агентского)
         :param ad_ids:          list of int - список айди объявлений
+        :param flush:           True - сразу отправить изменения, False - оставить в очереди до flush_updates
 
         """
-        for i in range(0, len(ad_ids), 5):
-            try:
-                ids = ad_ids[i: i + 5]
-            except IndexError:
-                ids = ad_ids[i:]
-            data_list = []
-            for x in ids:
-                data = {'ad_id': x, 'status': 0}
-                data_list.append(data)
-            data = json.dumps(data_list)
-            url = f'https://api.vk.com/method/ads.updateAds?account_id={cabinet_id}&' \
-                  f'data={data}&' \
-                  f'access_token={self.token}&v=5.103'
-            resp = self.session.get(url).json()
-            print(resp)
-            time.sleep(1)
+        queue = self._update_queue(cabinet_id)
+        for ad_id in ad_ids:
+            queue.put(ad_id, status=0)
+        if flush:
+            self.flush_updates(cabinet_id)
 
-    def start_ads(self, cabinet_id, ad_ids):
+    def start_ads(self, cabinet_id, ad_ids, flush=True):
         """
         Запускает остановленные объявления
 
         :param cabinet_id:      int - айди рекламного кабинета (личного или агентского)
         :param ad_ids:          list of int - список айди объявлений
+        :param flush:           True - сразу отправить изменения, False - оставить в очереди до flush_updates
 
         """
-        for i in range(0, len(ad_ids), 5):
-            try:
-                ids = ad_ids[i: i + 5]
-            except IndexError:
-                ids = ad_ids[i:]
-            data_list = []
-            for x in ids:
-                data = {'ad_id': x, 'status': 1}
-                data_list.append(data)
-            data = json.dumps(data_list)
-            url = f'https://api.vk.com/method/ads.updateAds?account_id={cabinet_id}&' \
-                  f'data={data}&' \
-                  f'access_token={self.token}&v=5.103'
-            resp = self.session.get(url).json()
-            time.sleep(1)
-
-    def update_cpm(self, cabinet_id, cpm_dict):
+        queue = self._update_queue(cabinet_id)
+        for ad_id in ad_ids:
+            queue.put(ad_id, status=1)
+        if flush:
+            self.flush_updates(cabinet_id)
+
+    def update_cpm(self, cabinet_id, cpm_dict, flush=True):
         """
-        Останавливает активные объявления
+        Обновляет CPM объявлений
 
         :param cabinet_id:      int - айди рекламного кабинета (личного или агентского)
         :param cpm_dict:        dict - {ad_id: cpm}, cpm - float в рублях с копейками после точки
+        :param flush:           True - сразу отправить изменения, False - оставить в очереди до flush_updates
 
         """
-        data_list = []
+        queue = self._update_queue(cabinet_id)
         for ad_id, cpm in cpm_dict.items():
-            if len(data_list) < 4:
-                data = {'ad_id': ad_id, 'cpm': cpm}
-                data_list.append(data)
-            else:
-                data = {'ad_id': ad_id, 'cpm': cpm}
-                data_list.append(data)
-                data = json.dumps(data_list)
-                url = f'https://api.vk.com/method/ads.updateAds?account_id={cabinet_id}&' \
-                      f'data={data}&' \
-                      f'access_token={self.token}&v=5.103'
-                resp = self.session.get(url).json()
-                print(resp)
-                data_list = []
-                time.sleep(1)
-        if data_list:
-            data = json.dumps(data_list)
-            url = f'https://api.vk.com/method/ads.updateAds?account_id={cabinet_id}&' \
-                  f'data={data}&' \
-                  f'access_token={self.token}&v=5.103'
-            resp = self.session.get(url).json()
-            print(resp)
-
+            queue.put(ad_id, cpm=cpm)
+        if flush:
+            self.flush_updates(cabinet_id)
 
-# TODO  Добавить ожидание появления кликабельных элемнтов в VkGroupAudio
@@ -0,0 +1,102 @@
+""" Use python 3.7 """
+
+import datetime
+import os
+import tracemalloc
+import psutil
+
+
+# Если задан, между тиками автоматизации снимаются снимки памяти и отчет пишется в этот файл
+MEMORY_FILE = os.environ.get('VK_MEMORY_FILE')
+
+
+class MemoryMonitor:
+    """
+    Слежение за ростом памяти в многодневной автоматизации.
+
+    На каждом тике снимается снимок tracemalloc и сравнивается с предыдущим - в отчет попадают
+    места в коде, где выделенная память выросла сильнее всего. Кроме того записывается RSS
+    самого процесса и суммарный RSS дочерних процессов (chromedriver и Chrome).
+
+    Отчет дописывается в файл path, по одному блоку на тик:
+
+        2020-04-01 12:00:00 python rss 182.4 MB, browsers rss 1460.2 MB (9 processes), traced 35.1 MB
+            +2.1 MB (+31000 blocks) models/vk/backend.py:412
+            ...
+
+    Параметры:
+
+        path - str, файл отчета, если не задан - слежение выключено
+
+        top - int, сколько мест с наибольшим ростом показывать
+
+        frames - int, глубина стека, которую запоминает tracemalloc
+
+    """
+
+    def __init__(self, path=MEMORY_FILE, top=10, frames=1):
+        self.path = path
+        self.top = top
+        self.frames = frames
+        self.snapshot = None
+        self.process = psutil.Process()
+
+    def start(self):
+        if not self.path:
+            return
+        # tracemalloc мог запустить не монитор (PYTHONTRACEMALLOC=1), базовый снимок нужен в любом случае
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        if self.snapshot is None:
+            self.snapshot = self._take_snapshot()
+
+    def _take_snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<unknown>'),
+        ))
+
+    def rss(self):
+        """ RSS процесса и его дочерних процессов в байтах: (python_rss, browsers_rss, browsers_count) """
+        python_rss = self.process.memory_info().rss
+        browsers_rss = 0
+        children = self.process.children(recursive=True)
+        for child in children:
+            try:
+                browsers_rss += child.memory_info().rss
+            except psutil.Error:
+                # Процесс браузера мог завершиться между children() и memory_info()
+                pass
+        return python_rss, browsers_rss, len(children)
+
+    def tick(self):
+        """ Снимок памяти и запись в отчет роста с предыдущего тика """
+        if not self.path:
+            return
+        if not tracemalloc.is_tracing() or self.snapshot is None:
+            # Первый тик только снимает базовый снимок, сравнивать пока не с чем
+            self.start()
+            return
+
+        snapshot = self._take_snapshot()
+        stats = snapshot.compare_to(self.snapshot, 'lineno')
+        self.snapshot = snapshot
+
+        python_rss, browsers_rss, browsers_count = self.rss()
+        traced, _ = tracemalloc.get_traced_memory()
+        lines = [f'{datetime.datetime.now():%Y-%m-%d %H:%M:%S} python rss {python_rss / 2 ** 20:.1f} MB, '
+                 f'browsers rss {browsers_rss / 2 ** 20:.1f} MB ({browsers_count} processes), '
+                 f'traced {traced / 2 ** 20:.1f} MB']
+        growing = [stat for stat in stats if stat.size_diff > 0][:self.top]
+        for stat in growing:
+            frame = stat.traceback[0]
+            lines.append(f'    {stat.size_diff / 2 ** 20:+.1f} MB ({stat.count_diff:+d} blocks) '
+                         f'{frame.filename}:{frame.lineno}')
+
+        with open(self.path, 'a', encoding='utf-8') as file:
+            file.write('\n'.join(lines) + '\n')
+
+
+# Слежение за памятью процесса
+memory = MemoryMonitor()
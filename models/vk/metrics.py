@@ -0,0 +1,133 @@
+""" Use python 3.7 """
+
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Границы корзин гистограммы времени выполнения в секундах
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60.)
+
+# Если задан, метрики записываются в этот файл после каждого тика обновления CPM
+METRICS_FILE = os.environ.get('VK_METRICS_FILE')
+
+
+class Metrics:
+    """
+    Метрики вызовов: количество, гистограмма времени выполнения, коды ошибок и повторы.
+
+    Метрики группируются по семействам (family) - 'vk_api' для методов VK API и 'vk_browser'
+    для шагов selenium в VkGroupAudio, внутри семейства - по названию метода (name).
+    Один объект общий для процесса (metrics), выгружается в текстовом формате Prometheus
+    через to_prometheus() или в файл через dump().
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = {}         # {(family, name): count}
+            self.seconds = {}       # {(family, name): [bucket_counts, sum]}
+            self.errors = {}        # {(family, name, code): count}
+            self.retries = {}       # {(family, name): count}
+
+    def observe(self, family, name, seconds, error_code=None):
+        """ Записывает один вызов и время его выполнения, error_code - код ошибки, если вызов упал """
+        key = (family, name)
+        with self.lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+            if key not in self.seconds:
+                self.seconds[key] = [[0] * len(BUCKETS), 0.]
+            histogram = self.seconds[key]
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += seconds
+        if error_code is not None:
+            self.error(family, name, error_code)
+
+    def error(self, family, name, error_code):
+        key = (family, name, str(error_code))
+        with self.lock:
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def retry(self, family, name):
+        key = (family, name)
+        with self.lock:
+            self.retries[key] = self.retries.get(key, 0) + 1
+
+    @contextmanager
+    def timer(self, family, name):
+        """ Замеряет блок кода, исключение записывается как ошибка с кодом - названием класса исключения """
+        start = time.perf_counter()
+        error_code = None
+        try:
+            yield
+        except Exception as err:
+            error_code = type(err).__name__
+            raise
+        finally:
+            self.observe(family, name, time.perf_counter() - start, error_code)
+
+    def timed(self, family, name):
+        """ Декоратор для метода, замеряет каждый его вызов через timer """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(family, name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def to_prometheus(self):
+        """ Метрики в текстовом формате Prometheus """
+        with self.lock:
+            lines = []
+            families = sorted({family for family, _ in self.calls})
+            for family in families:
+                lines.append(f'# TYPE {family}_calls_total counter')
+                for (fam, name), count in sorted(self.calls.items()):
+                    if fam == family:
+                        lines.append(f'{family}_calls_total{{method="{name}"}} {count}')
+
+                lines.append(f'# TYPE {family}_seconds histogram')
+                for (fam, name), (buckets, total) in sorted(self.seconds.items()):
+                    if fam != family:
+                        continue
+                    for bound, count in zip(BUCKETS, buckets):
+                        lines.append(f'{family}_seconds_bucket{{method="{name}",le="{bound}"}} {count}')
+                    count = self.calls[(fam, name)]
+                    lines.append(f'{family}_seconds_bucket{{method="{name}",le="+Inf"}} {count}')
+                    lines.append(f'{family}_seconds_sum{{method="{name}"}} {total:.6f}')
+                    lines.append(f'{family}_seconds_count{{method="{name}"}} {count}')
+
+                lines.append(f'# TYPE {family}_errors_total counter')
+                for (fam, name, code), count in sorted(self.errors.items()):
+                    if fam == family:
+                        lines.append(f'{family}_errors_total{{method="{name}",code="{code}"}} {count}')
+
+                lines.append(f'# TYPE {family}_retries_total counter')
+                for (fam, name), count in sorted(self.retries.items()):
+                    if fam == family:
+                        lines.append(f'{family}_retries_total{{method="{name}"}} {count}')
+
+            return '\n'.join(lines) + '\n'
+
+    def dump(self, path=None):
+        """ Записывает метрики в файл (по умолчанию METRICS_FILE), если путь не задан - ничего не делает """
+        path = path or METRICS_FILE
+        if not path:
+            return
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            file.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+
+# Метрики, общие для всех объектов в процессе
+metrics = Metrics()
@@ -0,0 +1,225 @@
+""" Use python 3.7 """
+
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class MockVkApi:
+    """
+    Локальная замена VK API для замеров и отладки без реальных запросов и трат.
+
+    Поддерживает методы, которые вызывает VkAdsBackend: ads.*, wall.postAdsStealth, groups.*
+    и execute (в том виде, в котором его формирует VkAdsBackend._execute_code).
+    Все данные (кампании, объявления, посты) хранятся в памяти объекта.
+
+
+    Параметры:
+
+        latency - float, задержка ответа на каждый запрос в секундах
+
+        error_rate - float от 0 до 1, доля запросов, на которые сервер ответит ошибкой
+
+        error_codes - tuple of int, коды ошибок, из которых случайно выбирается ошибка
+
+        retarget_count - int, сколько баз ретаргета вернет ads.getTargetGroups
+
+
+    Использование:
+
+        api = MockVkApi(latency=0.05).start()
+        backend.api_url = api.url
+        ...
+        api.stop()
+
+    """
+
+    def __init__(self, latency=0., error_rate=0., error_codes=(6,), retarget_count=100, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_codes = error_codes
+        self.retarget_count = retarget_count
+        self.requests = 0
+        self.methods = {}
+        self.lock = threading.Lock()
+        self.ids = iter(range(1000000, 10 ** 9))
+        self.campaigns = {}
+        self.ads = {}
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/method'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = 0
+            self.methods = {}
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def _respond(self, params):
+                method = urlparse(self.path).path.rsplit('/', 1)[-1]
+                body = json.dumps(api.handle(method, params), ensure_ascii=False).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self._respond(parse_qs(urlparse(self.path).query))
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                self._respond(parse_qs(self.rfile.read(length).decode()))
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def handle(self, method, params):
+        """ Ответ на один HTTP запрос к методу API """
+        params = {key: value[0] for key, value in params.items()}
+        with self.lock:
+            self.requests += 1
+            self.methods[method] = self.methods.get(method, 0) + 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if self.error_rate and random.random() < self.error_rate:
+            code = random.choice(self.error_codes)
+            return {'error': {'error_code': code, 'error_msg': f'mock error {code}'}}
+
+        if method == 'execute':
+            return self._execute(params['code'])
+
+        try:
+            return {'response': self._call(method, params)}
+        except (KeyError, ValueError) as err:
+            return {'error': {'error_code': 100, 'error_msg': f'One of the parameters specified was missing '
+                                                             f'or invalid: {err}'}}
+
+    def _execute(self, code):
+        """ Разбор кода вида return [API.method({...}), API.method({...})]; """
+        decoder = json.JSONDecoder()
+        results = []
+        errors = []
+        for match in re.finditer(r'API\.([\w.]+)\(', code):
+            params, _ = decoder.raw_decode(code, match.end())
+            params = {key: value if isinstance(value, str) else json.dumps(value) for key, value in params.items()}
+            try:
+                results.append(self._call(match.group(1), params))
+            except (KeyError, ValueError) as err:
+                results.append(False)
+                errors.append({'method': match.group(1), 'error_code': 100, 'error_msg': str(err)})
+
+        resp = {'response': results}
+        if errors:
+            resp['execute_errors'] = errors
+        return resp
+
+    def _call(self, method, params):
+        with self.lock:
+            if method == 'ads.getAccounts':
+                return [{'account_id': 1, 'account_name': 'mock', 'account_type': 'general'},
+                        {'account_id': 2, 'account_name': 'mock agency', 'account_type': 'agency'}]
+
+            if method == 'ads.getClients':
+                return [{'id': 3, 'name': 'mock client'}]
+
+            if method == 'ads.getTargetGroups':
+                return [{'id': n, 'name': f'base {n}', 'audience_count': 1000000}
+                        for n in range(1, self.retarget_count + 1)]
+
+            if method == 'ads.getCampaigns':
+                return [{'id': campaign_id, 'name': name} for campaign_id, name in self.campaigns.items()]
+
+            if method == 'ads.createCampaigns':
+                campaign_id = next(self.ids)
+                self.campaigns[campaign_id] = json.loads(params['data'])[0]['name']
+                return [{'id': campaign_id}]
+
+            if method == 'ads.createAds':
+                ads = []
+                for data in json.loads(params['data']):
+                    ad_id = next(self.ids)
+                    self.ads[ad_id] = {'id': ad_id, 'campaign_id': data['campaign_id'], 'name': data['name'],
+                                       'cpm': str(int(data['cpm'] * 100)), 'status': data['status'],
+                                       'all_limit': str(data['all_limit']), 'impressions': 0, 'spent': 0.}
+                    ads.append({'id': ad_id})
+                return ads
+
+            if method == 'ads.getAds':
+                campaign_ids = json.loads(params['campaign_ids'])
+                return [{key: ad[key] for key in ('id', 'campaign_id', 'name', 'cpm', 'status', 'all_limit')}
+                        for ad in self.ads.values() if ad['campaign_id'] in campaign_ids]
+
+            if method == 'ads.updateAds':
+                result = []
+                for data in json.loads(params['data']):
+                    ad = self.ads.get(data['ad_id'])
+                    if ad is None:
+                        result.append({'id': data['ad_id'], 'error_code': 603, 'error_desc': 'ad not found'})
+                        continue
+                    if 'cpm' in data:
+                        ad['cpm'] = str(int(float(data['cpm']) * 100))
+                    if 'status' in data:
+                        ad['status'] = data['status']
+                    if 'all_limit' in data:
+                        ad['all_limit'] = str(data['all_limit'])
+                    result.append({'id': ad['id']})
+                return result
+
+            if method == 'ads.deleteAds':
+                return [0 if self.ads.pop(ad_id, None) else 603
+                        for ad_id in json.loads(params['ids'])]
+
+            if method == 'ads.getStatistics':
+                ids = [int(x) for x in str(params['ids']).split(',') if x]
+                if params['ids_type'] == 'campaign':
+                    ads = [ad for ad in self.ads.values() if ad['campaign_id'] in ids]
+                    return [{'id': ids[0], 'stats': [{'spent': sum(ad['spent'] for ad in ads),
+                                                      'impressions': sum(ad['impressions'] for ad in ads)}]}]
+                stats = []
+                for ad_id in ids:
+                    ad = self.ads[ad_id]
+                    # Каждый запрос статы "докручивает" запущенные объявления
+                    if ad['status'] == 1:
+                        ad['impressions'] += random.randint(100, 1000)
+                        ad['spent'] = round(ad['impressions'] * int(ad['cpm']) / 100000, 2)
+                    stat = [{'spent': ad['spent'], 'impressions': ad['impressions']}] if ad['impressions'] else []
+                    stats.append({'id': ad_id, 'stats': stat})
+                return stats
+
+            if method == 'wall.postAdsStealth':
+                return {'post_id': next(self.ids)}
+
+            if method == 'groups.create':
+                return {'id': next(self.ids)}
+
+            if method in ('groups.edit', 'groups.editManager'):
+                return 1
+
+        raise ValueError(f'unknown method {method}')
@@ -0,0 +1,140 @@
+""" Use python 3.7 """
+
+import cProfile
+import datetime
+import os
+import signal
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Сколько тиков профилировать сразу после запуска автоматизации (0 - не профилировать)
+PROFILE_TICKS = int(os.environ.get('VK_PROFILE_TICKS', 0))
+
+# Папка для файлов профиля
+PROFILE_DIR = os.environ.get('VK_PROFILE_DIR', 'profiles')
+
+
+class StackSampler:
+    """
+    Сэмплирует стек одного потока из фонового потока и копит стеки в свернутом формате
+    flame graph (строки 'func1;func2;func3 count'), который понимают flamegraph.pl и speedscope.
+
+    """
+
+    def __init__(self, thread_id, interval=0.01):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+
+    def _run(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            time.sleep(self.interval)
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as file:
+            for stack, count in sorted(self.stacks.items()):
+                file.write(f'{stack} {count}\n')
+
+
+class Profiler:
+    """
+    Профилирование долгой автоматизации по запросу, без ее перезапуска.
+
+    Профилируется окно из нескольких тиков обновления CPM (сон между тиками в профиль не попадает).
+    Окно включается:
+
+        - переменной окружения VK_PROFILE_TICKS=N - первые N тиков после запуска автоматизации
+        - сигналом SIGUSR1 (kill -USR1 <pid>, только не на Windows) - следующие N тиков,
+          N берется из VK_PROFILE_TICKS, по умолчанию 1
+
+    По окончании окна в папку VK_PROFILE_DIR записываются два файла:
+
+        <время>-<pid>.prof - профиль cProfile, смотреть через pstats, snakeviz и т.п.
+        <время>-<pid>.folded - стеки для flame graph (flamegraph.pl, speedscope)
+
+    """
+
+    def __init__(self, directory=PROFILE_DIR, ticks=PROFILE_TICKS):
+        self.directory = directory
+        self.ticks = ticks or 1
+        self.armed = ticks
+        self.signal_installed = False
+        self.profile = None
+        self.sampler = None
+
+    def install_signal(self):
+        """ Включает окно профилирования по сигналу SIGUSR1, вне главного потока сигнал не ставится """
+        if self.signal_installed or not hasattr(signal, 'SIGUSR1'):
+            return
+        # signal.signal работает только в главном потоке, иначе выбрасывает ValueError
+        if threading.current_thread() is not threading.main_thread():
+            return
+        signal.signal(signal.SIGUSR1, self._on_signal)
+        self.signal_installed = True
+
+    def _on_signal(self, signum, frame):
+        self.request()
+
+    def request(self, ticks=None):
+        """ Профилировать следующие ticks тиков """
+        self.armed = ticks or self.ticks
+        print(f'Профилирование следующих {self.armed} тиков')
+
+    @contextmanager
+    def tick(self):
+        """ Один тик автоматизации, профилируется, если окно включено """
+        if not self.armed:
+            yield
+            return
+
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+            self.sampler = StackSampler(threading.get_ident())
+        self.sampler.start()
+        self.profile.enable()
+        try:
+            yield
+        finally:
+            self.profile.disable()
+            self.sampler.stop()
+            self.armed -= 1
+            if not self.armed:
+                self.save()
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        name = f'{datetime.datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}'
+        prof_path = os.path.join(self.directory, f'{name}.prof')
+        self.profile.dump_stats(prof_path)
+        self.sampler.save(os.path.join(self.directory, f'{name}.folded'))
+        self.profile = None
+        self.sampler = None
+        print(f'Профиль записан в {prof_path}')
+
+
+# Профайлер процесса
+profiler = Profiler()
@@ -2,8 +2,12 @@
 
 from models.vk.backend import VkAdsBackend
 from models.database import *
-from models.vk.tools import get_token_and_user_id
+from models.vk.tools import token_store
 from models.vk.tools import CPMCalculator
+from models.vk.metrics import metrics
+from models.vk.tracing import tracer
+from models.vk.profiling import profiler
+from models.vk.memory import memory
 import time
 import datetime
 
@@ -59,10 +63,13 @@ class TargetingAssistant:
                                 если False, то этого ограничения в объявлениях не будет
                                 (по умолчанию - False)
 
+        playlist_workers - int, количество браузеров, которые параллельно создают плейлисты
+                           (по умолчанию - 3)
+
     """
     def __init__(self, user_id, login, password, token, artist_name, track_name, artist_group_id=None, cabinet_id=None,
                  client_id=None, fake_group_id=None, cover_path=None, citation=None, campaign_budget=0,
-                 music_interest_filter=False):
+                 music_interest_filter=False, playlist_workers=3):
 
         self.user_id = user_id
         self.artist_name = artist_name
@@ -78,6 +85,7 @@ class TargetingAssistant:
         self.retarget = self.Backend.get_retarget(self.cabinet_id, self.client_id)
         self.fake_group_id = self.__check_group_id(fake_group_id)
         self.cover_path = cover_path
+        self.playlist_workers = playlist_workers
         self.playlist_urls = []
         self.post_text = self._create_post_text(citation)
         self.dark_posts = {}
@@ -126,12 +134,18 @@ class TargetingAssistant:
 
         """
         # Добавление трека в аудиозаписи группы
-        self.Backend.add_audio_in_group(group_id=self.fake_group_id,
-                                        track_name=f'{self.artist_name} - {self.track_name}')
+        with tracer.span('add_audio_in_group', group_id=self.fake_group_id):
+            self.Backend.add_audio_in_group(group_id=self.fake_group_id,
+                                            track_name=f'{self.artist_name} - {self.track_name}')
         # Создание плейлистов
-        self.playlist_urls = self.Backend.create_playlists(group_id=self.fake_group_id, playlist_name=self.track_name,
-                                                           cover_path=self.cover_path, count=len(self.retarget))
-
+        with tracer.span('create_playlists', count=len(self.retarget), workers=self.playlist_workers) as span:
+            self.playlist_urls = self.Backend.create_playlists(group_id=self.fake_group_id,
+                                                               playlist_name=self.track_name,
+                                                               cover_path=self.cover_path, count=len(self.retarget),
+                                                               workers=self.playlist_workers)
+            span['created'] = len(self.playlist_urls)
+
+    @tracer.traced('start_test')
     def start_test(self):
         """
         Запускает тест по всем доступным в кабинете базам ретаргета:
@@ -152,19 +166,26 @@ class TargetingAssistant:
             self.create_playlists()
 
         # Создание дарк-постов
-        self.dark_posts = self.Backend.create_dark_posts(group_id=self.artist_group_id,
-                                                         playlists=self.playlist_urls,
-                                                         text=self.post_text)
+        with tracer.span('create_dark_posts', count=len(self.playlist_urls)) as span:
+            self.dark_posts = self.Backend.create_dark_posts(group_id=self.artist_group_id,
+                                                             playlists=self.playlist_urls,
+                                                             text=self.post_text)
+            span['created'] = len(self.dark_posts)
         # Создание новой кампании в кабинете
-        self.campaign_id = self.Backend.create_campaign(cabinet_id=self.cabinet_id, client_id=self.client_id,
-                                                        campaign_name=f'{self.artist_name.upper()} / {self.track_name}',
-                                                        money_limit=self.campaign_budget)
+        with tracer.span('create_campaign', cabinet_id=self.cabinet_id) as span:
+            self.campaign_id = self.Backend.create_campaign(cabinet_id=self.cabinet_id, client_id=self.client_id,
+                                                            campaign_name=f'{self.artist_name.upper()} / '
+                                                                          f'{self.track_name}',
+                                                            money_limit=self.campaign_budget)
+            span['campaign_id'] = self.campaign_id
         # Создание объявлений
-        ads = self.Backend.create_ads(cabinet_id=self.cabinet_id, client_id=self.client_id,
-                                      campaign_id=self.campaign_id,
-                                      retarget=self.retarget,
-                                      posts=list(self.dark_posts.keys()),
-                                      music=self.music_interest_filter)
+        with tracer.span('create_ads', count=len(self.dark_posts)) as span:
+            ads = self.Backend.create_ads(cabinet_id=self.cabinet_id, client_id=self.client_id,
+                                          campaign_id=self.campaign_id,
+                                          retarget=self.retarget,
+                                          posts=list(self.dark_posts.keys()),
+                                          music=self.music_interest_filter)
+            span['created'] = len(ads)
         self.ads = {ad_id: self.dark_posts[post_url] for ad_id, post_url in ads.items()}
         self.ad_names = self.Backend.ad_names
 
@@ -173,7 +194,8 @@ class TargetingAssistant:
     def get_ads_stat(self):
         """
         Возвращает полную необходимую стату в виде
-        dict - {ad_id: {'name': str, 'spent': float, 'reach': int, 'cpm': cpm}}
+        dict - {ad_id: {'name': str, 'spent': float, 'reach': int, 'cpm': cpm}},
+        None - если стату объявлений получить не удалось
 
         """
         # Проверка на наличие объявлений в объекте
@@ -184,7 +206,11 @@ class TargetingAssistant:
         ads_stat = self.Backend.get_ads_stat(cabinet_id=self.cabinet_id, ad_ids=list(self.ads.keys()),
                                              ad_names=self.ad_names, campaign_id=self.campaign_id,
                                              client_id=self.client_id)
-        listens = self.Backend.get_listens(group_id=self.fake_group_id, playlist_name=self.track_name)
+        if ads_stat is None:
+            return None
+        # Читаются только плейлисты объявлений кампании, а не весь раздел плейлистов паблика
+        listens = self.Backend.get_listens(group_id=self.fake_group_id, playlist_name=self.track_name,
+                                           playlist_urls=list(self.ads.values()))
 
         # Объединение статы объявлений и прослушиваний плейлистов
         full_stat = {}
@@ -205,14 +231,15 @@ class TargetingAssistant:
         """
         return self.Backend.get_campaign_stat(cabinet_id=self.cabinet_id, campaign_id=self.campaign_id)
 
-    def stop_ads(self, ad_ids):
+    def stop_ads(self, ad_ids, flush=True):
         """
         Останавливает объявления.
 
         :param ad_ids:      list of int - список айди объявлений
+        :param flush:       True - сразу отправить изменения в ВК, False - дождаться flush_updates
 
         """
-        self.Backend.stop_ads(cabinet_id=self.cabinet_id, ad_ids=ad_ids)
+        self.Backend.stop_ads(cabinet_id=self.cabinet_id, ad_ids=ad_ids, flush=flush)
         print(f'Остановлено {len(ad_ids)} объявлений')
 
     def start_ads(self, ad_ids):
@@ -251,16 +278,25 @@ class TargetingAssistant:
         self.Backend.limit_ads(cabinet_id=self.cabinet_id, ad_ids=ad_ids, limit=0)
         print(f'Сняты лимиты по бюджету с {len(ad_ids)} объявлений')
 
-    def update_cpm(self, cpm_dict):
+    def update_cpm(self, cpm_dict, flush=True):
         """
         Обновляет СРМ у объявлений
 
         :param cpm_dict:        dict - {ad_id: cpm}, cpm - float в рублях с копейками после точки
+        :param flush:           True - сразу отправить изменения в ВК, False - дождаться flush_updates
 
         """
-        self.Backend.update_cpm(cabinet_id=self.cabinet_id, cpm_dict=cpm_dict)
+        self.Backend.update_cpm(cabinet_id=self.cabinet_id, cpm_dict=cpm_dict, flush=flush)
         print(f'Обновлен СРМ у {len(cpm_dict)} объявлений')
 
+    def flush_updates(self):
+        """
+        Отправляет в ВК накопленные изменения объявлений (СРМ, статус, лимиты),
+        все изменения одного объявления уходят одним элементом
+
+        """
+        self.Backend.flush_updates(cabinet_id=self.cabinet_id)
+
 
 class TargetingManager:
     """
@@ -340,12 +376,12 @@ class TargetingManager:
 
         # Если такого логина нет в базе данных, создается новый аккаунт и вносится в БД
         if not user:
-            token, user_id = get_token_and_user_id(login, password)
+            token, user_id = token_store.get(login, password)
             user = Users.create(login=login, password=password, token=token, user_id=user_id)
             return user
         # Если логин есть, но не совпадают пароли, добывается новый токен и обновляется в БД вместе с паролем
         elif user.password != password:
-            token, user_id = get_token_and_user_id(login, password)
+            token, user_id = token_store.get(login, password)
             user.password = password
             user.save()
             user.token = token
@@ -499,6 +535,7 @@ class TargetingManager:
             campaign_details[campaign] = details
         return campaign_details
 
+    @tracer.traced('wait_moderation')
     def _wait_moderation(self):
         moderation = True
         while moderation:
@@ -509,15 +546,14 @@ class TargetingManager:
             else:
                 time.sleep(1200)
 
+    @tracer.traced('clean_after_test')
     def _clean_after_test(self):
         # Удаление объявлений, не прошедших тест, снятие лимитов с объявлений, прошедших тест
         ads_stat = self.get_ads_stat()
         all_ads = ads_stat.keys()
         fail_ads = self.Calculator.failed_ads(ads_stat)
         good_ads = list(set(all_ads) - set(fail_ads))
-        time.sleep(1)
         self.delete_ads(fail_ads)
-        time.sleep(1)
         self.unlimit_ads(good_ads)
         # Обновление словаря объявлений в ассистенте
         ads = self.Assistant.ads
@@ -531,10 +567,23 @@ class TargetingManager:
         time_now = datetime.datetime.now()
         while time_now < end_time:
             time.sleep(cpm_update_interval)
-            ads_stat = self.get_ads_stat()
-            cpm_dict, stop_ads = self.Calculator.updates_for_target_cost(ads_stat)
-            self.update_cpm(cpm_dict)
-            self.stop_ads(stop_ads)
+            with tracer.span('cpm_tick') as span, profiler.tick():
+                ads_stat = self.get_ads_stat()
+                if ads_stat is None:
+                    # ВК недоступен или предохранитель открыт - ставки обновятся на следующем тике
+                    print('Не удалось получить стату объявлений, тик пропущен')
+                    span['skipped'] = True
+                else:
+                    cpm_dict, stop_ads = self.Calculator.updates_for_target_cost(ads_stat)
+                    # Изменения ставок и остановки отправляются одним пакетом
+                    self.update_cpm(cpm_dict, flush=False)
+                    self.stop_ads(stop_ads, flush=False)
+                    self.flush_updates()
+                    span.update(ads=len(ads_stat), cpm_updates=len(cpm_dict), stopped=len(stop_ads))
+            # Выгрузка метрик тика в файл VK_METRICS_FILE, если он задан
+            metrics.dump()
+            # Снимок памяти и отчет о ее росте в файл VK_MEMORY_FILE, если он задан
+            memory.tick()
 
     def _wait_campaign_start(self, start_time):
         time_now = datetime.datetime.now()
@@ -588,22 +637,24 @@ class TargetingManager:
             cabinet = AgencyCabinets.get_by_id(client_cabinet.owner)
             return cabinet, campaign, client_cabinet
 
+    @tracer.traced('new_user_campaign')
     def _new_user_campaign(self, artist_group_id, fake_group_id, artist_name, cabinet, campaign_budget, citation,
                            cover_path, music_interest_filter, track_name):
         # Инициализирует ассистента для работы с личным кабинетом
-        self.Assistant = TargetingAssistant(user_id=self.user.user_id,
-                                            login=self.user.login,
-                                            password=self.user.password,
-                                            token=self.user.token,
-                                            artist_name=artist_name,
-                                            track_name=track_name,
-                                            artist_group_id=artist_group_id,
-                                            fake_group_id=fake_group_id,
-                                            cabinet_id=cabinet.cabinet_id,
-                                            cover_path=cover_path,
-                                            citation=citation,
-                                            campaign_budget=campaign_budget,
-                                            music_interest_filter=music_interest_filter)
+        with tracer.span('init_assistant', cabinet_id=cabinet.cabinet_id):
+            self.Assistant = TargetingAssistant(user_id=self.user.user_id,
+                                                login=self.user.login,
+                                                password=self.user.password,
+                                                token=self.user.token,
+                                                artist_name=artist_name,
+                                                track_name=track_name,
+                                                artist_group_id=artist_group_id,
+                                                fake_group_id=fake_group_id,
+                                                cabinet_id=cabinet.cabinet_id,
+                                                cover_path=cover_path,
+                                                citation=citation,
+                                                campaign_budget=campaign_budget,
+                                                music_interest_filter=music_interest_filter)
         # Запускает тест, получает айди объявлений и новой кампании
         self.Assistant.start_test()
         ads = self.Assistant.ads
@@ -635,25 +686,28 @@ class TargetingManager:
         for k, v in ads_stat.items():
             print(k, v)
 
-        self.automate_campaign(tested=True)
+        with tracer.span('automate_campaign', ads=len(ads_tested)):
+            self.automate_campaign(tested=True)
 
+    @tracer.traced('new_client_campaign')
     def _new_client_campaign(self, agency_cabinet, artist_group_id, fake_group_id, artist_name, campaign_budget,
                              citation, client_cabinet, cover_path, music_interest_filter, track_name):
         # Инициализирует ассистента для работы с клиентским кабинетом
-        self.Assistant = TargetingAssistant(user_id=self.user.user_id,
-                                            login=self.user.login,
-                                            password=self.user.password,
-                                            token=self.user.token,
-                                            artist_name=artist_name,
-                                            track_name=track_name,
-                                            artist_group_id=artist_group_id,
-                                            fake_group_id=fake_group_id,
-                                            cabinet_id=agency_cabinet.cabinet_id,
-                                            client_id=client_cabinet.cabinet_id,
-                                            cover_path=cover_path,
-                                            citation=citation,
-                                            campaign_budget=campaign_budget,
-                                            music_interest_filter=music_interest_filter)
+        with tracer.span('init_assistant', cabinet_id=agency_cabinet.cabinet_id, client_id=client_cabinet.cabinet_id):
+            self.Assistant = TargetingAssistant(user_id=self.user.user_id,
+                                                login=self.user.login,
+                                                password=self.user.password,
+                                                token=self.user.token,
+                                                artist_name=artist_name,
+                                                track_name=track_name,
+                                                artist_group_id=artist_group_id,
+                                                fake_group_id=fake_group_id,
+                                                cabinet_id=agency_cabinet.cabinet_id,
+                                                client_id=client_cabinet.cabinet_id,
+                                                cover_path=cover_path,
+                                                citation=citation,
+                                                campaign_budget=campaign_budget,
+                                                music_interest_filter=music_interest_filter)
         # Запускает тест, получает айди объявлений и новой кампании
         self.Assistant.start_test()
         ads = self.Assistant.ads
@@ -685,7 +739,8 @@ class TargetingManager:
         for k, v in ads_stat.items():
             print(k, v)
 
-        self.automate_campaign(tested=True)
+        with tracer.span('automate_campaign', ads=len(ads_tested)):
+            self.automate_campaign(tested=True)
 
     def start_new_campaign(self, artist_name, track_name, artist_group_id, cover_path=None, citation=None,
                            user_cabinet_name=None, agency_cabinet_name=None, client_cabinet_name=None,
@@ -783,14 +838,15 @@ class TargetingManager:
         """
         self.Assistant.start_ads(ad_ids)
 
-    def stop_ads(self, ad_ids):
+    def stop_ads(self, ad_ids, flush=True):
         """
-        Запуск объявлений
+        Остановка объявлений
 
         :param ad_ids:      list of int - список айди объявлений
+        :param flush:       True - сразу отправить изменения в ВК, False - дождаться flush_updates
 
         """
-        self.Assistant.stop_ads(ad_ids)
+        self.Assistant.stop_ads(ad_ids, flush)
 
     def delete_ads(self, ad_ids):
         """
@@ -811,14 +867,19 @@ class TargetingManager:
         """
         self.Assistant.unlimit_ads(ad_ids)
 
-    def update_cpm(self, cpm_dict):
+    def update_cpm(self, cpm_dict, flush=True):
         """
         Обновляет СРМ у объявлений
 
         :param cpm_dict:        dict - {ad_id: cpm}, cpm - float в рублях с копейками после точки
+        :param flush:           True - сразу отправить изменения в ВК, False - дождаться flush_updates
 
         """
-        self.Assistant.update_cpm(cpm_dict)
+        self.Assistant.update_cpm(cpm_dict, flush)
+
+    def flush_updates(self):
+        """ Отправляет в ВК накопленные изменения объявлений """
+        self.Assistant.flush_updates()
 
     def automate_campaign(self, target_rate=0.04, stop_rate=0.03, target_cost=1., stop_cost=1.5, cpm_step=10.,
                           cpm_update_interval=1200, tested=True):
@@ -837,6 +898,10 @@ class TargetingManager:
         :return:                        dict - итоговая стата по всем объявлениям через час после остановки кампании
 
         """
+        # Профилирование тиков по сигналу SIGUSR1 или переменной VK_PROFILE_TICKS
+        profiler.install_signal()
+        # Первый снимок памяти, с которым сравнивается первый тик
+        memory.start()
         # Инициализация калькулятора
         self.Calculator = CPMCalculator(target_rate=target_rate, stop_rate=stop_rate,
                                         target_cost=target_cost, stop_cost=stop_cost, cpm_step=cpm_step)
@@ -1,8 +1,15 @@
 """ Use python 3.7 """
 
 import getpass
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
 from html.parser import HTMLParser
 import requests
+from PIL import Image
 
 
 class FormParser(HTMLParser):
@@ -55,6 +62,167 @@ class FormParser(HTMLParser):
             self.in_denial = False
 
 
+def listens_count(text):
+    """
+    Количество прослушиваний из текста счетчика ВК: '12 345' -> 12345, '12,345' -> 12345, '1.2K' -> 1200,
+    '1,2K' -> 1200, '3M' -> 3000000. Запятая - десятичный разделитель только перед K/M, иначе это разделитель
+    разрядов, как и пробел.
+
+    """
+    text = ''.join(text.split())
+    if not text:
+        return 0
+    if text[-1] in 'KК':
+        return int(round(float(text[:-1].replace(',', '.')) * 1000))
+    if text[-1] in 'MМ':
+        return int(round(float(text[:-1].replace(',', '.')) * 1000000))
+    return int(text.replace(',', '').replace('.', ''))
+
+
+def prepare_cover(cover_path, size=1000, quality=85, directory=None):
+    """
+    Уменьшение и сжатие обложки плейлистов один раз перед созданием пачки плейлистов.
+
+    Изображение уменьшается так, чтобы большая сторона была не больше size, и сохраняется в jpeg.
+    Готовый файл кэшируется в directory (по умолчанию - во временной папке) по хэшу содержимого
+    и параметрам, поэтому повторные вызовы для той же обложки не пересжимают ее.
+
+    :return:    str - абсолютный путь к подготовленной обложке
+
+    """
+    with open(cover_path, 'rb') as file:
+        digest = hashlib.sha1(file.read()).hexdigest()
+    directory = directory or os.path.join(tempfile.gettempdir(), 'vk_covers')
+    prepared_path = os.path.join(directory, f'{digest}_{size}_{quality}.jpg')
+    if os.path.exists(prepared_path):
+        return prepared_path
+
+    os.makedirs(directory, exist_ok=True)
+    with Image.open(cover_path) as image:
+        image = image.convert('RGB')
+        image.thumbnail((size, size), Image.LANCZOS)
+        tmp_path = f'{prepared_path}.tmp'
+        image.save(tmp_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+    os.replace(tmp_path, prepared_path)
+    return prepared_path
+
+
+class PlaylistParser(HTMLParser):
+    """
+    Потоковый разбор раздела плейлистов паблика без построения дерева страницы.
+
+    Из каждого блока audio_pl_item2 берутся только ссылка на плейлист, название и счетчик прослушиваний,
+    результат - список playlists из кортежей (url, title, listens), listens - int.
+
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.playlists = []
+        self.in_item = False
+        self.item_depth = 0
+        self.capture = None
+        self.capture_tag = None
+        self.capture_depth = 0
+        self.url = None
+        self.title_url = None
+        self.text = {'title': [], 'listens': []}
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'div' and self.in_item:
+            self.item_depth += 1
+        if self.capture and tag == self.capture_tag:
+            self.capture_depth += 1
+
+        for name, value in attrs:
+            if name != 'class' or not value:
+                continue
+            classes = value.split()
+            if not self.in_item:
+                if tag == 'div' and any(x.startswith('audio_pl_item2') for x in classes):
+                    self.in_item = True
+                    self.item_depth = 1
+                    self.url = self.title_url = None
+                    self.text = {'title': [], 'listens': []}
+                return
+            if 'audio_pl__cover' in classes:
+                self.url = dict(attrs).get('href')
+            elif 'audio_item__title' in classes:
+                self.title_url = dict(attrs).get('href')
+                self._start_capture('title', tag)
+            elif 'audio_pl__stats_listens' in classes:
+                self._start_capture('listens', tag)
+            return
+
+    def _start_capture(self, name, tag):
+        if self.capture is None:
+            self.capture = name
+            self.capture_tag = tag
+            self.capture_depth = 1
+
+    def handle_endtag(self, tag):
+        if self.capture and tag == self.capture_tag:
+            self.capture_depth -= 1
+            if not self.capture_depth:
+                self.capture = None
+        if tag == 'div' and self.in_item:
+            self.item_depth -= 1
+            if not self.item_depth:
+                self.in_item = False
+                link = self.url or self.title_url
+                if link:
+                    self.playlists.append((f'https://vk.com{link}', ''.join(self.text['title']).strip(),
+                                           listens_count(''.join(self.text['listens']))))
+
+    def handle_data(self, data):
+        if self.capture:
+            self.text[self.capture].append(data)
+
+
+class PlaylistPageParser(HTMLParser):
+    """
+    Потоковый разбор страницы одного плейлиста (https://vk.com/music/playlist/...): берется только
+    счетчик прослушиваний из шапки плейлиста (элемент с классом *__stats_listens),
+    результат - listens, int, None - если счетчика на странице нет.
+
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.listens = None
+        self.capture_tag = None
+        self.capture_depth = 0
+        self.text = []
+
+    def handle_starttag(self, tag, attrs):
+        if self.capture_tag is not None:
+            if tag == self.capture_tag:
+                self.capture_depth += 1
+            return
+        if self.listens is not None:
+            return
+        classes = (dict(attrs).get('class') or '').split()
+        if any(x.endswith('__stats_listens') for x in classes):
+            self.capture_tag = tag
+            self.capture_depth = 1
+            self.text = []
+
+    def handle_endtag(self, tag):
+        if self.capture_tag is None or tag != self.capture_tag:
+            return
+        self.capture_depth -= 1
+        if not self.capture_depth:
+            self.capture_tag = None
+            # Счетчик может идти вместе с подписью: '12 345 прослушиваний'
+            match = re.search(r'\d[\d\s,.]*[KКMМ]?', ''.join(self.text))
+            if match:
+                self.listens = listens_count(match.group())
+
+    def handle_data(self, data):
+        if self.capture_tag is not None:
+            self.text.append(data)
+
+
 class VKAuth(object):
 
     def __init__(self, permissions, app_id, api_v, email=None, pswd=None, two_factor_auth=False, security_code=None,
@@ -270,6 +438,124 @@ def get_token_and_user_id(login, password):
     return token, user_id
 
 
+def read_json(path):
+    """ Содержимое json файла, пустой словарь - если файла нет или он поврежден """
+    try:
+        with open(path, encoding='utf-8') as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_json(path, data):
+    """ Атомарная запись json файла: через временный файл, чтобы не оставить его недописанным """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(data, file)
+    os.replace(tmp_path, path)
+
+
+class TokenStore:
+    """
+    Хранилище токенов на диске, чтобы не проходить авторизацию VKAuth при каждом запуске.
+
+    Токены хранятся в json файле в виде {login: {'token': str, 'user_id': str, 'password': sha256}}.
+    Сохраненный токен не проверяется заранее: новый токен получается, только если сменился пароль
+    или ВК ответил, что токен недействителен (см. refresh).
+
+    """
+
+    def __init__(self, path='database/tokens.json'):
+        self.path = path
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _password_hash(password):
+        return hashlib.sha256(str(password).encode()).hexdigest()
+
+    def _load(self):
+        return read_json(self.path)
+
+    def _save(self, tokens):
+        write_json(self.path, tokens)
+
+    def _login(self, tokens, login, password):
+        token, user_id = get_token_and_user_id(login, password)
+        tokens[str(login)] = {'token': token, 'user_id': user_id, 'password': self._password_hash(password)}
+        self._save(tokens)
+        return token, user_id
+
+    def get(self, login, password):
+        """
+        Возвращает сохраненный токен аккаунта, авторизуется через VKAuth только если токена нет
+        или он был получен с другим паролем
+
+        :return:        tuple - (token, user_id)
+
+        """
+        with self.lock:
+            tokens = self._load()
+            saved = tokens.get(str(login))
+            if saved and saved['password'] == self._password_hash(password):
+                return saved['token'], saved['user_id']
+            return self._login(tokens, login, password)
+
+    def refresh(self, login, password, bad_token):
+        """
+        Получает новый токен вместо недействительного bad_token.
+        Если токен уже обновил кто-то другой (другой объект или процесс), возвращает его без авторизации.
+
+        :return:        tuple - (token, user_id)
+
+        """
+        with self.lock:
+            tokens = self._load()
+            saved = tokens.get(str(login))
+            if saved and saved['token'] != bad_token and saved['password'] == self._password_hash(password):
+                return saved['token'], saved['user_id']
+            return self._login(tokens, login, password)
+
+
+token_store = TokenStore()
+
+
+class CookieStore:
+    """
+    Хранилище кук браузера на диске, чтобы VkGroupAudio не входил в ВК через форму при каждом запуске.
+
+    Куки хранятся в json файле в виде {login: [cookie, ...]}, cookie - словарь в формате
+    selenium get_cookies или Chrome DevTools Network.getAllCookies.
+
+    """
+
+    def __init__(self, path='database/cookies.json'):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def get(self, login):
+        """ Сохраненные куки аккаунта, None - если их нет """
+        with self.lock:
+            return read_json(self.path).get(str(login))
+
+    def set(self, login, cookies):
+        with self.lock:
+            data = read_json(self.path)
+            data[str(login)] = cookies
+            write_json(self.path, data)
+
+    def delete(self, login):
+        with self.lock:
+            data = read_json(self.path)
+            if data.pop(str(login), None) is not None:
+                write_json(self.path, data)
+
+
+cookie_store = CookieStore()
+
+
 def listens_rate(ads_stat):
     """
     Возвращает конверсию из охвата объявлений в прослушивания плейлистов в виде
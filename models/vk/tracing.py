@@ -0,0 +1,85 @@
+""" Use python 3.7 """
+
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Tracer:
+    """
+    Вложенные замеры времени (спаны) шагов кампании.
+
+    Спаны пишутся в файл в формате Chrome Trace Event (открывается в chrome://tracing
+    или ui.perfetto.dev). Файл перезаписывается, когда завершается спан верхнего уровня, и не реже
+    раза в save_interval секунд, поэтому трейс долгой автоматизации можно смотреть, не дожидаясь ее окончания.
+
+    Если путь к файлу не задан, спаны не записываются.
+
+        with tracer.span('create_ads', ads=len(retarget)) as span:
+            ads = backend.create_ads(...)
+            span['created'] = len(ads)
+
+    """
+
+    def __init__(self, path=None, save_interval=60.):
+        self.path = path
+        self.save_interval = save_interval
+        self.last_save = time.time()
+        self.events = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """ Спан name с атрибутами attrs, атрибуты можно дополнять через возвращаемый словарь """
+        if not self.path:
+            yield attrs
+            return
+
+        depth = getattr(self.local, 'depth', 0)
+        self.local.depth = depth + 1
+        start = time.time()
+        try:
+            yield attrs
+        except Exception as err:
+            attrs['error'] = repr(err)
+            raise
+        finally:
+            duration = time.time() - start
+            self.local.depth = depth
+            event = {'name': name, 'ph': 'X', 'pid': self.pid, 'tid': threading.get_ident(),
+                     'ts': int(start * 1000000), 'dur': int(duration * 1000000),
+                     'args': {key: str(value) if not isinstance(value, (int, float)) else value
+                              for key, value in attrs.items()}}
+            with self.lock:
+                self.events.append(event)
+            if depth == 0 or time.time() - self.last_save > self.save_interval:
+                self.save()
+
+    def traced(self, name):
+        """ Декоратор для метода, каждый его вызов записывается спаном name """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, file, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            self.last_save = time.time()
+
+
+# Трейсер процесса, пишет в файл из переменной окружения VK_TRACE_FILE
+tracer = Tracer(os.environ.get('VK_TRACE_FILE'))
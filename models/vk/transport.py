@@ -0,0 +1,122 @@
+""" Use python 3.7 """
+
+import gzip
+import json
+import threading
+import requests
+
+
+def exchange_key(url, data):
+    """ Ключ запроса в кассете: метод API и параметры без токена """
+    method = url.rsplit('/', 1)[-1]
+    params = {key: str(value) for key, value in (data or {}).items() if key != 'access_token'}
+    return json.dumps([method, params], sort_keys=True, ensure_ascii=False)
+
+
+class CassetteResponse:
+    """ Ответ из кассеты с тем же интерфейсом, что использует VkAdsBackend у requests.Response """
+
+    def __init__(self, url, status_code, body):
+        self.url = url
+        self.status_code = status_code
+        self.text = body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f'{self.status_code} for {self.url}', response=self)
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class RecordingSession:
+    """
+    Транспорт для VkAdsBackend.session, который отправляет запросы через обычную сессию requests
+    и записывает все обмены с API в кассету - gzip файл, одна строка json на запрос.
+    Токен в кассету не попадает.
+
+    Кассета записывается на диск при вызове save() или close().
+
+        session = RecordingSession('cassettes/campaign.jsonl.gz')
+        backend = VkAdsBackend(login, password, token, session=session)
+        ...
+        session.save()
+
+    """
+
+    rate_limited = True
+
+    def __init__(self, path, session=None):
+        self.path = path
+        self.session = session if session is not None else requests.session()
+        self.exchanges = []
+        self.lock = threading.Lock()
+
+    def post(self, url, data=None, **kwargs):
+        response = self.session.post(url, data=data, **kwargs)
+        with self.lock:
+            self.exchanges.append({'key': exchange_key(url, data),
+                                   'status': response.status_code,
+                                   'body': response.text})
+        return response
+
+    def save(self):
+        with self.lock:
+            with gzip.open(self.path, 'wt', encoding='utf-8') as file:
+                for exchange in self.exchanges:
+                    file.write(json.dumps(exchange, ensure_ascii=False, separators=(',', ':')))
+                    file.write('\n')
+
+    def close(self):
+        self.save()
+        self.session.close()
+
+
+class ReplaySession:
+    """
+    Транспорт для VkAdsBackend.session, который отвечает на запросы из кассеты RecordingSession
+    без обращения к сети.
+
+    Одинаковые запросы получают записанные ответы в том порядке, в котором они были записаны,
+    поэтому повторный прогон того же кода детерминирован. Если на запрос в кассете не осталось ответа,
+    выбрасывается LookupError.
+
+    Ограничитель частоты с этим транспортом не нужен (rate_limited = False), поэтому прогон идет
+    с максимальной скоростью и показывает накладные расходы нашего кода.
+
+    """
+
+    rate_limited = False
+
+    def __init__(self, path):
+        self.path = path
+        self.responses = {}
+        self.requests = 0
+        self.methods = {}
+        self.lock = threading.Lock()
+        with gzip.open(path, 'rt', encoding='utf-8') as file:
+            for line in file:
+                exchange = json.loads(line)
+                self.responses.setdefault(exchange['key'], []).append((exchange['status'], exchange['body']))
+        for responses in self.responses.values():
+            responses.reverse()
+
+    def post(self, url, data=None, **kwargs):
+        key = exchange_key(url, data)
+        method = url.rsplit('/', 1)[-1]
+        with self.lock:
+            self.requests += 1
+            self.methods[method] = self.methods.get(method, 0) + 1
+            responses = self.responses.get(key)
+            if not responses:
+                raise LookupError(f'no recorded response for {key}')
+            status, body = responses.pop()
+        return CassetteResponse(url, status, body)
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = 0
+            self.methods = {}
+
+    def close(self):
+        pass